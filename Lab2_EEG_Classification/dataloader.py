@@ -1,6 +1,14 @@
+import os
+import json
+import math
 import numpy as np
+import torch
+from torch.utils.data import TensorDataset
 
-def read_bci_data():
+SOURCES = ('S4b_train.npz', 'X11b_train.npz', 'S4b_test.npz', 'X11b_test.npz')
+ARRAYS = ('train_data', 'train_label', 'test_data', 'test_label')
+
+def preprocess_bci_data():
     S4b_train = np.load('S4b_train.npz')
     X11b_train = np.load('X11b_train.npz')
     S4b_test = np.load('S4b_test.npz')
@@ -16,7 +24,7 @@ def read_bci_data():
     test_label = test_label -1
     train_data = np.transpose(np.expand_dims(train_data, axis=1), (0, 1, 3, 2))
     test_data = np.transpose(np.expand_dims(test_data, axis=1), (0, 1, 3, 2))
-   
+
 
     mask = np.where(np.isnan(train_data))
     train_data[mask] = np.nanmean(train_data)
@@ -24,8 +32,66 @@ def read_bci_data():
     mask = np.where(np.isnan(test_data))
     test_data[mask] = np.nanmean(test_data)
 
-   
+    # (N, 1, 2, 750) float32, laid out contiguously for the cache
+    train_data = np.ascontiguousarray(train_data, dtype=np.float32)
+    test_data = np.ascontiguousarray(test_data, dtype=np.float32)
 
     return train_data, train_label, test_data, test_label
 
+def read_bci_data(cache_dir='bci_cache'):
+    """
+        The arrays of preprocess_bci_data, written once as uncompressed .npy files to
+        cache_dir and memory-mapped read-only afterwards, so startup skips the npz
+        decompression and the NaN filling, and concurrent runs share the same pages.
+        The cache is rebuilt when the mtime of any source .npz changes.
+        Pass cache_dir=None to preprocess in memory without a cache.
+    """
+    if cache_dir is None:
+        return preprocess_bci_data()
+
+    mtimes = {name: os.stat(name).st_mtime_ns for name in SOURCES}
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    paths = [os.path.join(cache_dir, name + '.npy') for name in ARRAYS]
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == mtimes and all(os.path.exists(path) for path in paths):
+                return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for path, array in zip(paths, preprocess_bci_data()):
+        # write next to the target and rename, so a crashed run never leaves half a cache
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+    # the index is written last, it only matches once every array is in place
+    with open(meta_path, 'w') as f:
+        json.dump(mtimes, f)
+    return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+class DeviceLoader:
+    """
+        Drop-in for DataLoader(TensorDataset(*tensors), batch_size, shuffle) on data that
+        fits on the device: the tensors are moved there once, so batches need no collation
+        or host-to-device copy. Shuffling permutes the data on the device with one randperm
+        per epoch, and every batch is a view of the (permuted) tensors.
+        len() and .dataset behave like the DataLoader's.
+    """
+    def __init__(self, *tensors, batch_size=1, shuffle=False, drop_last=False, device='cpu'):
+        self.tensors = tuple(torch.as_tensor(tensor).to(device) for tensor in tensors)
+        self.dataset = TensorDataset(*self.tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
 
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            index = torch.randperm(len(self.dataset), device=tensors[0].device)
+            tensors = tuple(tensor[index] for tensor in tensors)
+        for i in range(len(self)):
+            yield tuple(tensor[i * self.batch_size:(i + 1) * self.batch_size] for tensor in tensors)
@@ -1 +1,144 @@
-print("Please define your ResNet in this file.")
\ No newline at end of file
+import torch.nn as nn
+
+# Same modules and names as the models of the lab3_ResNet*.ipynb notebooks,
+# so their saved state_dicts (models/ResNet*/ResNet*_SGD.pth, ...) load as they are.
+
+class BasicBlock(nn.Module):
+    def __init__(self, in_channel, out_channel, stride, downsample=False):
+        super().__init__()
+
+        self.conv1 = nn.Sequential(
+            nn.Conv2d(in_channel, out_channel, kernel_size=(3, 3), stride=stride, padding=(1, 1), bias=False),
+            nn.BatchNorm2d(out_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(out_channel, out_channel, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False),
+            nn.BatchNorm2d(out_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
+        )
+
+        # downsample: makes input channel = out channel
+        if downsample:
+            self.down_sample = nn.Sequential(
+                nn.Conv2d(in_channel, out_channel, kernel_size=(1,1), stride=(2,2), bias=False),
+                nn.BatchNorm2d(out_channel)
+            )
+        else:
+            self.down_sample = nn.Identity()
+        self.ReLU = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        out = self.conv1(x)
+        residual = self.down_sample(x)
+        out = self.ReLU(out + residual)
+        return out
+
+def add_basic_blocks(in_channel, out_channel, stride, downsample):
+    basic_blocks = []
+    basic_blocks.append(BasicBlock(in_channel, out_channel, stride, downsample))
+    basic_blocks.append(BasicBlock(out_channel, out_channel, (1, 1), False))
+    return basic_blocks
+
+class BottleneckBlock(nn.Module):
+    def __init__(self, prev_channel, in_channel, out_channel, stride=(1, 1), downsample=False):
+        super().__init__()
+
+        # First bottleneck block needs to be downsampled
+        if downsample:
+            self.conv = nn.Sequential(
+                nn.Conv2d(prev_channel, out_channel, kernel_size=(1, 1), stride=(1, 1), bias=False),
+                nn.BatchNorm2d(out_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+                nn.Conv2d(out_channel, out_channel, kernel_size=(3, 3), stride=stride, padding=(1, 1), bias=False),
+                nn.BatchNorm2d(out_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+                nn.Conv2d(out_channel, in_channel, kernel_size=(1, 1), stride=(1, 1), bias=False),
+                nn.BatchNorm2d(in_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
+            )
+            self.down_sample = nn.Sequential(
+                nn.Conv2d(prev_channel, in_channel, kernel_size=(1,1), stride=stride, bias=False),
+                nn.BatchNorm2d(in_channel)
+            )
+        else:
+            self.conv = nn.Sequential(
+                nn.Conv2d(in_channel, out_channel, kernel_size=(1, 1), stride=(1, 1), bias=False),
+                nn.BatchNorm2d(out_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+                nn.Conv2d(out_channel, out_channel, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False),
+                nn.BatchNorm2d(out_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+                nn.Conv2d(out_channel, in_channel, kernel_size=(1, 1), stride=(1, 1), bias=False),
+                nn.BatchNorm2d(in_channel, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
+            )
+            self.down_sample = nn.Identity()
+
+        self.ReLU = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        out = self.conv(x)
+        residual = self.down_sample(x)
+        out = self.ReLU(out + residual)
+        return out
+
+def add_bottleneck_blocks(prev_channel, in_channel, out_channel, stride, num_blocks):
+    bottleneck_blocks = []
+    bottleneck_blocks.append(BottleneckBlock(prev_channel, in_channel, out_channel, stride, True))
+    for _ in range(num_blocks-1):
+        bottleneck_blocks.append(BottleneckBlock(prev_channel, in_channel, out_channel))
+    return bottleneck_blocks
+
+class ResNet(nn.Module):
+    def __init__(self, layers, out_channel):
+        super().__init__()
+
+        self.conv1 = nn.Sequential(
+            nn.Conv2d(3, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False),
+            nn.BatchNorm2d(64, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True,),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=(3, 3), stride=(2, 2), padding=(1, 1), dilation=1, ceil_mode=False),
+        )
+
+        self.layer1, self.layer2, self.layer3, self.layer4 = (nn.Sequential(*layer) for layer in layers)
+
+        self.avg_pool = nn.AdaptiveAvgPool2d(output_size=(1, 1)) # (output_H, output_W)
+        self.fc = nn.Linear(out_channel, 2)
+
+    def forward(self, x):
+        output = self.conv1(x)
+        output = self.layer1(output)
+        output = self.layer2(output)
+        output = self.layer3(output)
+        output = self.layer4(output)              # (num, out_channel, n, n)
+        output = self.avg_pool(output)            # (num, out_channel, 1, 1)
+        output = output.view(output.shape[0], -1) # (num, out_channel)
+        output = self.fc(output)                  # (num, 2)
+        return output
+
+class ResNet18(ResNet):
+    def __init__(self):
+        # Each layer has two basic blocks
+        super().__init__([
+            add_basic_blocks(64, 64, (1, 1), False),
+            add_basic_blocks(64, 128, (2, 2), True),
+            add_basic_blocks(128, 256, (2, 2), True),
+            add_basic_blocks(256, 512, (2, 2), True),
+        ], 512)
+
+class ResNet50(ResNet):
+    def __init__(self):
+        # Each layer has ($num_blocks) bottleneck blocks
+        super().__init__([
+            add_bottleneck_blocks(64, 256, 64, (1, 1), num_blocks=3),
+            add_bottleneck_blocks(256, 512, 128, (2, 2), num_blocks=4),
+            add_bottleneck_blocks(512, 1024, 256, (2, 2), num_blocks=6),
+            add_bottleneck_blocks(1024, 2048, 512, (2, 2), num_blocks=3),
+        ], 2048)
+
+class ResNet152(ResNet):
+    def __init__(self):
+        super().__init__([
+            add_bottleneck_blocks(64, 256, 64, (1, 1), num_blocks=3),
+            add_bottleneck_blocks(256, 512, 128, (2, 2), num_blocks=8),
+            add_bottleneck_blocks(512, 1024, 256, (2, 2), num_blocks=36),
+            add_bottleneck_blocks(1024, 2048, 512, (2, 2), num_blocks=3),
+        ], 2048)
+
+MODELS = {
+    'resnet18': ResNet18,
+    'resnet50': ResNet50,
+    'resnet152': ResNet152,
+}
@@ -1,62 +1,238 @@
+import os
+import csv
+import json
+import math
+import numpy as np
 import pandas as pd
+import torch
+import torch.nn.functional as F
 from PIL import Image
 from torch.utils import data
+from torchvision import transforms
 
-def getData(mode):
-    if mode == 'train':
-        df = pd.read_csv('Path to train.csv')
-        path = df['Path'].tolist()
-        label = df['label'].tolist()
-        return path, label
-    
-    elif mode == "valid":
-        df = pd.read_csv('Path to valid.csv')
-        path = df['Path'].tolist()
-        label = df['label'].tolist()
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+# CSV of each split, update it (or pass csv_path) to point at another layout
+CSV_PATHS = {
+    'train': 'train.csv',
+    'valid': 'valid.csv',
+    'test': 'resnet_18_test.csv',
+}
+
+def load_index(csv_path):
+    """
+        (path, label) arrays of a split CSV: path as a utf-8 byte string array, label as
+        int8, or None for the test CSV which has no label column. The CSV is parsed once and
+        cached as <csv>.index.npz next to it, the cache is rebuilt when the CSV's mtime changes.
+    """
+    cache_path = os.path.splitext(csv_path)[0] + '.index.npz'
+    mtime = os.stat(csv_path).st_mtime_ns
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as index:
+            if index['mtime'] == mtime:
+                return index['path'], index['label'] if 'label' in index.files else None
+
+    df = pd.read_csv(csv_path)
+    index = {'mtime': np.int64(mtime), 'path': np.char.encode(df['Path'].to_numpy(dtype=str), 'utf-8')}
+    if 'label' in df:
+        index['label'] = df['label'].to_numpy(dtype=np.int8)
+    # write next to the target and rename, so a crashed run never leaves half an index
+    with open(cache_path + '.tmp', 'wb') as f:
+        np.savez(f, **index)
+    os.replace(cache_path + '.tmp', cache_path)
+    return index['path'], index.get('label')
+
+def getData(mode, csv_path=None):
+    path, label = load_index(csv_path or CSV_PATHS[mode])
+    if mode == 'train' or mode == 'valid':
         return path, label
-    
-    else:
-        df = pd.read_csv('Path to resnet_18/50/152_test.csv')
-        path = df['Path'].tolist()
-        return path
+    # test: the paths are the IDs of the submission, main.save_result writes them as they are
+    return path
+
+def build_image_cache(root, mode, img_name, crop_size, cache_dir):
+    """
+        Decode and center-crop every image of a split once into
+        <cache_dir>/<mode>_<crop_size>.npy, a (N, 3, crop_size, crop_size) uint8 array
+        in the order of img_name, next to a .json index of the source images. The cache
+        is rebuilt when the index no longer matches. Returns the path of the .npy file.
+    """
+    name = os.path.join(cache_dir, f"{mode}_{crop_size}")
+    img_name = [os.fsdecode(path) for path in img_name]
+    if os.path.exists(name + '.json') and os.path.exists(name + '.npy'):
+        with open(name + '.json') as f:
+            if json.load(f) == img_name:
+                return name + '.npy'
+
+    os.makedirs(cache_dir, exist_ok=True)
+    crop = transforms.CenterCrop(crop_size)
+    cache = np.lib.format.open_memmap(name + '.tmp.npy', mode='w+', dtype=np.uint8,
+                                      shape=(len(img_name), 3, crop_size, crop_size))
+    for i, path in enumerate(img_name):
+        img = Image.open(os.path.join(root, path)).convert('RGB')
+        cache[i] = np.asarray(crop(img)).transpose(2, 0, 1)
+    cache.flush()
+    del cache
+    os.replace(name + '.tmp.npy', name + '.npy')
+    with open(name + '.json', 'w') as f:
+        json.dump(img_name, f)
+    return name + '.npy'
+
+class ChunkBatchSampler(data.Sampler):
+    """
+        Yields index batches that stay inside contiguous chunks of the dataset, so
+        every batch is one localized read of the memory-mapped cache. The chunk order
+        and the order inside each chunk are shuffled every epoch.
+        Use with DataLoader(dataset, batch_size=None, sampler=ChunkBatchSampler(...)).
+    """
+    def __init__(self, num_samples, batch_size, chunk_size=None, shuffle=True, drop_last=False):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size or batch_size * 8
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        starts = np.arange(0, self.num_samples, self.chunk_size)
+        if self.shuffle:
+            np.random.shuffle(starts)
+        for start in starts:
+            chunk = np.arange(start, min(start + self.chunk_size, self.num_samples))
+            if self.shuffle:
+                np.random.shuffle(chunk)
+            for i in range(0, len(chunk), self.batch_size):
+                batch = chunk[i:i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                # sorted, so the read walks the file forward
+                yield np.sort(batch)
+
+    def __len__(self):
+        full, rest = divmod(self.chunk_size, self.batch_size)
+        num_chunks, last_chunk = divmod(self.num_samples, self.chunk_size)
+        per_chunk = full + (0 if self.drop_last or rest == 0 else 1)
+        last = last_chunk // self.batch_size if self.drop_last else math.ceil(last_chunk / self.batch_size)
+        return num_chunks * per_chunk + last
+
+def normalize(images):
+    """uint8 (N, 3, H, W) batch on any device -> float, normalized like transforms.Normalize(MEAN, STD)"""
+    mean = torch.tensor(MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(STD, device=images.device).view(1, 3, 1, 1)
+    return (images.float() / 255 - mean) / std
+
+def random_flip_rotate(images, degrees=15):
+    """
+        RandomHorizontalFlip + RandomRotation(degrees) of a whole (N, C, H, W) batch in
+        two kernels on its own device, every image gets its own flip and angle.
+        As with RandomRotation's defaults, pixels are sampled nearest-neighbour and those
+        rotated in from outside are 0; apply before normalize.
+    """
+    n = images.shape[0]
+    dtype = images.dtype
+    images = images.float()
+    flip = torch.rand(n, device=images.device) < 0.5
+    images = torch.where(flip.view(n, 1, 1, 1), images.flip(-1), images)
+    angle = (torch.rand(n, device=images.device) * 2 - 1) * math.radians(degrees)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    zero = torch.zeros_like(angle)
+    theta = torch.stack([torch.stack([cos, -sin, zero], 1), torch.stack([sin, cos, zero], 1)], 1)
+    grid = F.affine_grid(theta, images.shape, align_corners=False)
+    images = F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+    return images.round_().to(dtype) if dtype == torch.uint8 else images
+
+class CSVImageStream(data.IterableDataset):
+    """
+        Streams (ID, center-cropped uint8 image) pairs from a test CSV of any size, reading
+        the CSV row by row instead of loading it. With DataLoader workers, worker w decodes the
+        batches b with b % num_workers == w; since the DataLoader takes one batch from each
+        worker in turn, the batches come out in CSV order. batch_size must match the DataLoader's.
+        Normalize the images on the device with normalize().
+    """
+    def __init__(self, csv_path, root, batch_size, crop_size=410):
+        self.csv_path = csv_path
+        self.root = root
+        self.batch_size = batch_size
+        self.crop = transforms.CenterCrop(crop_size)
+
+    def __iter__(self):
+        info = data.get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        with open(self.csv_path, newline='') as f:
+            reader = csv.reader(f)
+            column = next(reader).index('Path')
+            for i, row in enumerate(reader):
+                if (i // self.batch_size) % num_workers != worker_id:
+                    continue
+                img = Image.open(os.path.join(self.root, row[column])).convert('RGB')
+                yield row[column], torch.from_numpy(np.asarray(self.crop(img)).transpose(2, 0, 1).copy())
 
 class LeukemiaLoader(data.Dataset):
-    def __init__(self, root, mode):
+    def __init__(self, root, mode, cache_dir=None, crop_size=410, csv_path=None):
         """
         Args:
             mode : Indicate procedure status(training or testing)
+            csv_path (string): CSV of the split, defaults to CSV_PATHS[mode].
+            cache_dir (string): If set, images are center-cropped once into the memory-mapped
+                                cache of build_image_cache and returned as uint8 tensors;
+                                flip/rotation and normalization are then left to
+                                random_flip_rotate and normalize on the device.
+            crop_size (int): Side of the center crop.
 
-            self.img_name (string list): String list that store all image names.
-            self.label (int or float list): Numerical list that store all ground truth label values.
+            self.img_name (bytes array): Utf-8 paths of all images, see load_index.
+            self.label (int8 array): Ground truth label of every image, None in test mode.
         """
         self.root = root
-        self.img_name, self.label = getData(mode)
+        if mode == 'train' or mode == 'valid':
+            self.img_name, self.label = getData(mode, csv_path)
+        else:
+            self.img_name, self.label = getData(mode, csv_path), None
         self.mode = mode
-        print("> Found %d images..." % (len(self.img_name)))  
+        print("> Found %d images..." % (len(self.img_name)))
+
+        if mode == 'train':
+            self.transform = transforms.Compose([
+                transforms.CenterCrop(crop_size),
+                transforms.RandomHorizontalFlip(),
+                transforms.RandomRotation(degrees=15),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=MEAN, std=STD),
+            ])
+        else:
+            self.transform = transforms.Compose([
+                transforms.CenterCrop(crop_size),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=MEAN, std=STD),
+            ])
+
+        self.cache_path = None
+        self._cache = None
+        if cache_dir is not None:
+            self.cache_path = build_image_cache(root, mode, self.img_name, crop_size, cache_dir)
+
+    def __getstate__(self):
+        # DataLoader workers map the cache themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
 
     def __len__(self):
         """'return the size of dataset"""
         return len(self.img_name)
 
     def __getitem__(self, index):
-        """something you should implement here"""
-
         """
-           step1. Get the image path from 'self.img_name' and load it.
-                  hint : path = root + self.img_name[index] + '.jpeg'
-           
-           step2. Get the ground truth label from self.label
-                     
-           step3. Transform the .jpeg rgb images during the training phase, such as resizing, random flipping, 
-                  rotation, cropping, normalization etc. But at the beginning, I suggest you follow the hints. 
-                       
-                  In the testing phase, if you have a normalization process during the training phase, you only need 
-                  to normalize the data. 
-                  
-                  hints : Convert the pixel value to [0, 1]
-                          Transpose the image shape from [H, W, C] to [C, H, W]
-                         
-            step4. Return processed image and label
+            index is one position, or a whole batch of positions from ChunkBatchSampler,
+            which is read from the cache in one go
         """
+        if self.cache_path is not None:
+            if self._cache is None:
+                # copy-on-write mapping, so torch gets a writable array without copying
+                self._cache = np.load(self.cache_path, mmap_mode='c')
+            img = torch.from_numpy(np.ascontiguousarray(self._cache[index]))
+        else:
+            img = Image.open(os.path.join(self.root, os.fsdecode(self.img_name[index]))).convert('RGB')
+            img = self.transform(img)
 
-        return img, label
\ No newline at end of file
+        if self.label is None:
+            return img
+        return img, torch.as_tensor(self.label[index], dtype=torch.long)
@@ -1,20 +1,102 @@
-import pandas as pd
+import argparse
+import csv
+import os
+import time
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from dataloader import CSV_PATHS, CSVImageStream, getData, normalize
+from ResNet import MODELS
 
 def evaluate():
     print("evaluate() not defined")
 
-def test():
-    print("test() not defined")
+def load_model(arch, checkpoint, device):
+    """ResNet of the notebooks with the state_dict they saved (torch.save(model.state_dict(), ...))"""
+    model = MODELS[arch]()
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    return model.to(device).eval()
+
+class Ensemble(nn.Module):
+    """
+        Averages the logits of several models on the same decoded batch. With tta, the
+        horizontally and vertically flipped copies are concatenated to the batch, so each
+        model still runs a single forward pass, and their logits are averaged too.
+    """
+    def __init__(self, models, tta=False):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+        self.tta = tta
+
+    def forward(self, x):
+        n = x.shape[0]
+        if self.tta:
+            x = torch.cat([x, x.flip(-1), x.flip(-2)])
+        logits = torch.stack([model(x) for model in self.models]).mean(0)
+        return logits.view(-1, n, logits.shape[-1]).mean(0)
+
+def load_ensemble(archs, checkpoints, device, tta=False):
+    """one model per checkpoint, archs holds one arch per checkpoint or a single one for all"""
+    if len(archs) == 1:
+        archs = archs * len(checkpoints)
+    assert len(archs) == len(checkpoints), "give one --arch per --checkpoint, or a single --arch"
+    models = [load_model(arch, checkpoint, device) for arch, checkpoint in zip(archs, checkpoints)]
+    if len(models) == 1 and not tta:
+        return models[0]
+    return Ensemble(models, tta).to(device).eval()
+
+def test(model, test_loader, output_path, device, flush_every=50):
+    """
+        Predict the streamed test images batch by batch and append every batch to
+        output_path as soon as it is done, so only one batch of predictions is held.
+        Returns the number of images written.
+    """
+    count = 0
+    start_time = time.time()
+    with torch.inference_mode(), open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'label'])
+        for i, (ids, images) in enumerate(test_loader):
+            images = normalize(images.to(device, non_blocking=True))
+            pred = model(images).argmax(dim=1)
+            writer.writerows(zip(ids, pred.tolist()))
+            count += len(ids)
+            if (i + 1) % flush_every == 0:
+                f.flush()
+    print(f"> Wrote {count} predictions to {output_path} ({count / (time.time() - start_time):.1f} images/sec)")
+    return count
 
 def train():
     print("train() not defined")
 
-def save_result(csv_path, predict_result):
-    df = pd.read_csv(csv_path)
-    new_df = pd.DataFrame()
-    new_df['ID'] = df['Path']
-    new_df["label"] = predict_result
-    new_df.to_csv("./your_student_id_resnet18.csv", index=False)
+def save_result(ids, predict_result, output_path="./your_student_id_resnet18.csv"):
+    # ids: getData('test'), or the path of the test CSV whose cached index is used
+    if isinstance(ids, str):
+        ids = getData('test', ids)
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'label'])
+        writer.writerows(zip(map(os.fsdecode, ids), map(int, predict_result)))
 
 if __name__ == "__main__":
-    print("Good Luck :)")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Leukemia classification inference')
+    parser.add_argument('--arch',        type=str, default=['resnet18'], choices=list(MODELS), nargs='+',
+                        help="One per checkpoint, or one for all of them")
+    parser.add_argument('--checkpoint',  type=str, required=True,      nargs='+',
+                        help="state_dicts saved by the notebooks, e.g. models/ResNet18/ResNet18_SGD.pth; several are ensembled")
+    parser.add_argument('--tta',         action='store_true',          help="Also average over the flipped images, in the same forward pass")
+    parser.add_argument('--test_csv',    type=str, default=CSV_PATHS['test'])
+    parser.add_argument('--root',        type=str, default='.',        help="Directory the paths of the CSV are relative to")
+    parser.add_argument('--output',      type=str, default='./your_student_id_resnet18.csv')
+    parser.add_argument('--batch_size',  type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--crop_size',   type=int, default=410)
+    parser.add_argument('--device',      type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    model = load_ensemble(args.arch, args.checkpoint, args.device, args.tta)
+    # decoding runs in the workers while the model runs on the previous batch
+    test_loader = DataLoader(CSVImageStream(args.test_csv, args.root, args.batch_size, args.crop_size),
+                             batch_size=args.batch_size, num_workers=args.num_workers,
+                             pin_memory=torch.device(args.device).type == 'cuda')
+    test(model, test_loader, args.output, args.device)
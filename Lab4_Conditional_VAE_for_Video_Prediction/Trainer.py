@@ -107,6 +107,11 @@ class VAE_Model(nn.Module):
         self.train_loss_list = []
         self.val_PSNR_list = []
         self.tfr_list = []
+
+        # built on first use and kept for the whole run, see train_dataloader
+        self.train_dataset = None
+        self.train_loader = None
+        self.val_loader = None
         
     def forward(self, img, label):
         pass
@@ -120,8 +125,8 @@ class VAE_Model(nn.Module):
             train_loss = 0
 
             for (img, label) in (pbar := tqdm(train_loader, ncols=180)):
-                img = img.to(self.args.device)
-                label = label.to(self.args.device)
+                img = self.to_device(img)
+                label = self.to_device(label)
                 loss = self.training_one_step(img, label, adapt_TeacherForcing)
 
                 train_loss += loss.item()
@@ -151,11 +156,18 @@ class VAE_Model(nn.Module):
     def eval(self):
         val_loader = self.val_dataloader()
         for (img, label) in (pbar := tqdm(val_loader, ncols=180)):
-            img = img.to(self.args.device)
-            label = label.to(self.args.device)
+            img = self.to_device(img)
+            label = self.to_device(label)
             loss = self.val_one_step(img, label)
             self.tqdm_bar('val', pbar, loss.detach().cpu(), lr=self.scheduler.get_last_lr()[0])
     
+    def to_device(self, x):
+        # frames from the --frame_cache are uint8, scale them like ToTensor but on the device
+        x = x.to(self.args.device)
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255)
+        return x
+
     def training_one_step(self, img, label, adapt_TeacherForcing):
 
         img = img.permute(1, 0, 2, 3, 4) # change tensor into (seq, B, C, H, W)
@@ -260,35 +272,42 @@ class VAE_Model(nn.Module):
                     save_all=True, duration=40, loop=0)
     
     def train_dataloader(self):
-        transform = transforms.Compose([
-            transforms.Resize((self.args.frame_H, self.args.frame_W)),
-            transforms.ToTensor()
-        ])
-
-        dataset = Dataset_Dance(root=self.args.DR, transform=transform, mode='train', video_len=self.train_vi_len, \
-                                                partial=args.fast_partial if self.args.fast_train else args.partial)
+        # The loader and its workers are created once. The sampler asks the dataset
+        # for its length every epoch, so switching partial only changes that view.
+        if self.train_loader is None:
+            transform = transforms.Compose([
+                transforms.Resize((self.args.frame_H, self.args.frame_W)),
+                transforms.ToTensor()
+            ])
+            self.train_dataset = Dataset_Dance(root=self.args.DR, transform=transform, mode='train', video_len=self.train_vi_len, \
+                                               cache_dir=self.args.frame_cache, frame_size=(self.args.frame_H, self.args.frame_W))
+            self.train_loader = DataLoader(self.train_dataset,
+                                           batch_size=self.batch_size,
+                                           num_workers=self.args.num_workers,
+                                           persistent_workers=self.args.num_workers > 0,
+                                           drop_last=True,
+                                           shuffle=False)
+
+        self.train_dataset.partial = self.args.fast_partial if self.args.fast_train else self.args.partial
         if self.current_epoch > self.args.fast_train_epoch:
             self.args.fast_train = False
-            
-        train_loader = DataLoader(dataset,
-                                  batch_size=self.batch_size,
-                                  num_workers=self.args.num_workers,
-                                  drop_last=True,
-                                  shuffle=False)  
-        return train_loader
+        return self.train_loader
     
     def val_dataloader(self):
-        transform = transforms.Compose([
-            transforms.Resize((self.args.frame_H, self.args.frame_W)),
-            transforms.ToTensor()
-        ])
-        dataset = Dataset_Dance(root=self.args.DR, transform=transform, mode='val', video_len=self.val_vi_len, partial=1.0)  
-        val_loader = DataLoader(dataset,
-                                  batch_size=1,
-                                  num_workers=self.args.num_workers,
-                                  drop_last=True,
-                                  shuffle=False)  
-        return val_loader
+        if self.val_loader is None:
+            transform = transforms.Compose([
+                transforms.Resize((self.args.frame_H, self.args.frame_W)),
+                transforms.ToTensor()
+            ])
+            dataset = Dataset_Dance(root=self.args.DR, transform=transform, mode='val', video_len=self.val_vi_len, partial=1.0, \
+                                    cache_dir=self.args.frame_cache, frame_size=(self.args.frame_H, self.args.frame_W))
+            self.val_loader = DataLoader(dataset,
+                                         batch_size=1,
+                                         num_workers=self.args.num_workers,
+                                         persistent_workers=self.args.num_workers > 0,
+                                         drop_last=True,
+                                         shuffle=False)  
+        return self.val_loader
     
     def teacher_forcing_ratio_update(self):
         if self.current_epoch % self.tfr_sde == 0:
@@ -389,6 +408,7 @@ if __name__ == '__main__':
     parser.add_argument('--DR',            type=str, required=True,  help="Your Dataset Path")
     parser.add_argument('--save_root',     type=str, required=True,  help="The path to save your data")
     parser.add_argument('--num_workers',   type=int, default=14)
+    parser.add_argument('--frame_cache',   type=str, default=None,  help="Directory of the pre-decoded frame cache, built on first use")
     parser.add_argument('--num_epoch',     type=int, default=61,    help="number of total epoch")
     parser.add_argument('--per_save',      type=int, default=3,      help="Save checkpoint every seted epoch")
     parser.add_argument('--partial',       type=float, default=1.0,  help="Part of the training dataset to be trained")
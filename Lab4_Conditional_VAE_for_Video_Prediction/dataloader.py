@@ -1,10 +1,14 @@
 
 import os
+import json
+from functools import lru_cache
 from glob import glob
+import numpy as np
 import torch
 from torch import stack
 from torch.utils.data import Dataset as torchData
 
+from torchvision import transforms
 from torchvision.datasets.folder import default_loader as imgloader
 from torch import stack
 def get_key(fp):
@@ -13,44 +17,103 @@ def get_key(fp):
     filename = filename.replace("train_img\\", '') 
     return int(filename)
 
+@lru_cache(maxsize=None)
+def get_file_index(root, prefix):
+    """
+        Sorted (frame, label) path pairs of one split, globbed and sorted once per process
+    """
+    img_folder = sorted(glob(os.path.join(root, f"{prefix}\\{prefix}_img\\*.png")), key=get_key)
+    label_folder = []
+    for img_name in img_folder:
+        label_list = img_name.split('\\')
+        label_list[-2] = prefix + '_label'
+        label_folder.append('/'.join(label_list))
+    return tuple(img_folder), tuple(label_folder)
+
+def build_frame_cache(root, prefix, frame_size, cache_dir):
+    """
+        Decode and resize every frame and pose label of a split once into
+        <cache_dir>/<prefix>_<H>x<W>.npy, a (N, 2, 3, H, W) uint8 array of (frame, label)
+        pairs, next to a .json index of the source frames. The cache is rebuilt when
+        the index no longer matches the dataset. Returns the path of the .npy file.
+    """
+    img_folder, label_folder = get_file_index(root, prefix)
+    name = os.path.join(cache_dir, f"{prefix}_{frame_size[0]}x{frame_size[1]}")
+    if os.path.exists(name + '.json') and os.path.exists(name + '.npy'):
+        with open(name + '.json') as f:
+            if json.load(f) == list(img_folder):
+                return name + '.npy'
+
+    os.makedirs(cache_dir, exist_ok=True)
+    resize = transforms.Resize(frame_size)
+    cache = np.lib.format.open_memmap(name + '.tmp.npy', mode='w+', dtype=np.uint8,
+                                      shape=(len(img_folder), 2, 3, *frame_size))
+    for i, (img_name, label_name) in enumerate(zip(img_folder, label_folder)):
+        cache[i, 0] = np.asarray(resize(imgloader(img_name))).transpose(2, 0, 1)
+        cache[i, 1] = np.asarray(resize(imgloader(label_name))).transpose(2, 0, 1)
+    cache.flush()
+    del cache
+    os.replace(name + '.tmp.npy', name + '.npy')
+    with open(name + '.json', 'w') as f:
+        json.dump(list(img_folder), f)
+    return name + '.npy'
+
 class Dataset_Dance(torchData):
     """
         Args:
             root (str)      : The path of your Dataset
             transform       : Transformation to your dataset
             mode (str)      : train, val, test
-            partial (float) : Percentage of your Dataset, may set to use part of the dataset
+            partial (float) : Percentage of your Dataset, may set to use part of the dataset.
+                              Only __len__ depends on it, so it can be changed between epochs
+                              without rebuilding the dataset or its DataLoader workers.
+            cache_dir (str) : If set, frames are read from the memory-mapped cache of
+                              build_frame_cache instead of the PNGs, and returned as uint8
+                              tensors (the transform is not applied, scale them by 1/255)
+            frame_size      : (H, W) of the cache, required with cache_dir
     """
-    def __init__(self, root, transform, mode='train', video_len=7, partial=1.0):
+    def __init__(self, root, transform, mode='train', video_len=7, partial=1.0, cache_dir=None, frame_size=None):
         super().__init__()
         assert mode in ['train', 'val'], "There is no such mode !!!"
         if mode == 'train':
-            self.img_folder     = sorted(glob(os.path.join(root, "train\\train_img\\*.png")), key=get_key)
             self.prefix = 'train'
         elif mode == 'val':
-            self.img_folder     = sorted(glob(os.path.join(root, "val\\val_img\\*.png")), key=get_key)
             self.prefix = 'val'
         else:
             raise NotImplementedError
+        self.img_folder, self.label_folder = get_file_index(root, self.prefix)
         
         self.transform = transform
         self.partial = partial
         self.video_len = video_len
 
+        self.cache_path = None
+        self._cache = None
+        if cache_dir is not None:
+            self.cache_path = build_frame_cache(root, self.prefix, tuple(frame_size), cache_dir)
+
+    def __getstate__(self):
+        # DataLoader workers map the cache themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
     def __len__(self):
         return int(len(self.img_folder) * self.partial) // self.video_len
 
     def __getitem__(self, index):
-        path = self.img_folder[index]
-        
+        if self.cache_path is not None:
+            if self._cache is None:
+                # copy-on-write mapping, so torch gets a writable array without copying
+                self._cache = np.load(self.cache_path, mmap_mode='c')
+            seq = self._cache[index*self.video_len:(index+1)*self.video_len]
+            return torch.from_numpy(seq[:, 0]), torch.from_numpy(seq[:, 1])
+
         imgs = []
         labels = []
         for i in range(self.video_len):
-            label_list = self.img_folder[(index*self.video_len)+i].split('\\')
-            label_list[-2] = self.prefix + '_label'
-            
-            img_name    = self.img_folder[(index*self.video_len)+i]
-            label_name = '/'.join(label_list)
+            img_name   = self.img_folder[(index*self.video_len)+i]
+            label_name = self.label_folder[(index*self.video_len)+i]
 
             imgs.append(self.transform(imgloader(img_name)))
             labels.append(self.transform(imgloader(label_name)))
@@ -2,9 +2,8 @@
 __author__ = 'chengscott'
 __copyright__ = 'Copyright 2020, NCTU CGI Lab'
 import argparse
-from collections import deque
+from functools import partial
 import itertools
-import random
 import time
 
 import gym
@@ -13,6 +12,8 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter
+from prioritized_memory import PrioritizedReplayMemory, prioritized_mse_loss
+from vec_env import SubprocVecEnv
 
 
 class GaussianNoise:
@@ -20,29 +21,45 @@ class GaussianNoise:
         self.mu = mu if mu else np.zeros(dim)
         self.std = std if std else np.ones(dim) * .1
 
-    def sample(self):
-        return np.random.normal(self.mu, self.std)
+    def sample(self, n=None):
+        size = None if n is None else (n, *np.shape(self.mu))
+        return np.random.normal(self.mu, self.std, size=size)
 
 
 class ReplayMemory:
-    __slots__ = ['buffer']
+    __slots__ = ['capacity', 'position', 'size', 'columns']
 
-    def __init__(self, capacity):
-        self.buffer = deque(maxlen=capacity)
+    def __init__(self, capacity, state_dim=8, action_dim=2):
+        self.capacity = capacity
+        self.position = 0
+        self.size = 0
+        # one contiguous float32 column per field of (state, action, reward, next_state, done)
+        self.columns = tuple(
+            np.empty((capacity, dim), dtype=np.float32)
+            for dim in (state_dim, action_dim, 1, state_dim, 1))
 
     def __len__(self):
-        return len(self.buffer)
+        return self.size
 
     def append(self, *transition):
         # (state, action, reward, next_state, done)
-        self.buffer.append(tuple(map(tuple, transition)))
+        self.extend(*(np.asarray(x)[None] for x in transition))
+
+    def extend(self, *transitions):
+        # each argument is a batch of one transition field
+        n = len(transitions[0])
+        slots = (self.position + np.arange(n)) % self.capacity
+        for column, x in zip(self.columns, transitions):
+            column[slots] = x
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
 
     def sample(self, batch_size, device):
-        '''sample a batch of transition tensors'''
+        '''sample a batch of float32 transition tensors'''
         ## TODO ##
-        transitions = random.sample(self.buffer, batch_size)
-        return (torch.tensor(x, dtype=float, device=device)
-                    for x in zip(*transitions)) 
+        indices = np.random.randint(0, self.size, size=batch_size)
+        return (torch.from_numpy(column[indices]).to(device, non_blocking=True)
+                for column in self.columns)
 
 
 class ActorNet(nn.Module):
@@ -103,7 +120,11 @@ class DDPG:
         # action noise
         self._action_noise = GaussianNoise(dim=2)
         # memory
-        self._memory = ReplayMemory(capacity=args.capacity)
+        self._prioritized = args.prioritized
+        if self._prioritized:
+            self._memory = PrioritizedReplayMemory(capacity=args.capacity)
+        else:
+            self._memory = ReplayMemory(capacity=args.capacity)
 
         ## config ##
         self.device = args.device
@@ -126,10 +147,22 @@ class DDPG:
         # change tensor back to a nparray and removes any unnecessary dimensions, 
         # resulting in a one-dimensional array representing the action
         return action.cpu().numpy().squeeze() 
+
+    def select_actions(self, states, noise=True):
+        '''actions for a batch of states in one forward pass'''
+        with torch.no_grad():
+            actions = self._actor_net(torch.from_numpy(states).to(self.device)).cpu().numpy()
+        if noise:
+            actions = actions + self._action_noise.sample(len(states))
+        return actions
     
     def append(self, state, action, reward, next_state, done):
         self._memory.append(state, action, [reward / 100], next_state, [int(done)])
 
+    def append_batch(self, states, actions, rewards, next_states, dones):
+        self._memory.extend(states, actions, rewards[:, None] / 100, next_states,
+                            dones[:, None].astype(int))
+
     def update(self):
         # update the behavior networks
         self._update_behavior_network(self.gamma)
@@ -144,24 +177,23 @@ class DDPG:
         actor_opt, critic_opt = self._actor_opt, self._critic_opt
 
         # sample a minibatch of transitions
-        state, action, reward, next_state, done = self._memory.sample(
-            self.batch_size, self.device)
+        if self._prioritized:
+            state, action, reward, next_state, done, weights, indices = self._memory.sample(
+                self.batch_size, self.device)
+            criterion = prioritized_mse_loss(self._memory, weights, indices)
+        else:
+            state, action, reward, next_state, done = self._memory.sample(
+                self.batch_size, self.device)
+            criterion = nn.MSELoss()
 
         ## update critic ##
         # critic loss
         ## TODO ##
-        state = state.to(torch.float32)
-        action = action.to(torch.float32)
-        next_state = next_state.to(torch.float32)
-
         q_value = self._critic_net(state, action)
         with torch.no_grad():
            a_next = self._target_actor_net(next_state)
            q_next = self._target_critic_net(next_state, a_next)
            q_target =  reward + gamma * q_next * (1 - done)
-        criterion = nn.MSELoss()
-        q_value = q_value.to(torch.float32)
-        q_target = q_target.to(torch.float32)
         critic_loss = criterion(q_value, q_target)
 
         # optimize critic
@@ -264,6 +296,55 @@ def train(args, env, agent, writer):
     env.close()
 
 
+def train_vec(args, env, agent, writer):
+    print('Start Training with {} environments'.format(args.num_envs))
+    envs = SubprocVecEnv([partial(gym.make, 'LunarLanderContinuous-v2') for _ in range(args.num_envs)])
+    total_steps = 0
+    ewma_reward = 0
+    episode = 0
+    total_rewards = np.zeros(args.num_envs)
+    lengths = np.zeros(args.num_envs, dtype=int)
+    states = envs.reset()
+    start_time = time.time()
+    while episode < args.episode:
+        # select actions
+        if total_steps < args.warmup:
+            actions = np.array([envs.action_space.sample() for _ in range(args.num_envs)])
+        else:
+            actions = agent.select_actions(states)
+        # execute actions
+        next_states, rewards, dones, ends = envs.step(actions)
+        # store transitions
+        agent.append_batch(states, actions, rewards, next_states, dones)
+        # keep one update per environment step
+        for _ in range(args.num_envs):
+            if total_steps >= args.warmup:
+                agent.update()
+            total_steps += 1
+
+        states = envs.states
+        total_rewards += rewards
+        lengths += 1
+        for i in np.flatnonzero(ends):
+            episode += 1
+            ewma_reward = 0.05 * total_rewards[i] + (1 - 0.05) * ewma_reward
+            writer.add_scalar('Train/Episode Reward', total_rewards[i],
+                              total_steps)
+            writer.add_scalar('Train/Ewma Reward', ewma_reward,
+                              total_steps)
+            print(
+                'Step: {}\tEpisode: {}\tLength: {:3d}\tTotal reward: {:.2f}\tEwma reward: {:.2f}\tSteps/s: {:.1f}'
+                .format(total_steps, episode, lengths[i], total_rewards[i],
+                        ewma_reward, total_steps / (time.time() - start_time)))
+            total_rewards[i], lengths[i] = 0, 0
+            if episode % 100 == 0:
+                model_path = f'model/ddpg/ddpg_episode={str(episode)}.pth'
+                agent.save(model_path, checkpoint=True)
+                test(args, env, agent, writer)
+    envs.close()
+    env.close()
+
+
 def test(args, env, agent, writer):
     print('Start Testing')
     seeds = (args.seed + i for i in range(10))
@@ -311,6 +392,8 @@ def main():
     parser.add_argument('--lrc', default=1e-3, type=float)
     parser.add_argument('--gamma', default=.99, type=float)
     parser.add_argument('--tau', default=.005, type=float)
+    parser.add_argument('--num_envs', default=1, type=int)
+    parser.add_argument('--prioritized', action='store_true')
     # test
     parser.add_argument('--test_only', action='store_true')
     parser.add_argument('--render', action='store_true')
@@ -324,7 +407,10 @@ def main():
     # model_path = f'model/ddpg/ddpg_episode={args.episode}.pth'
     model_path = "model/ddpg/ddpg_episode=1200.pth"
     if not args.test_only:
-        train(args, env, agent, writer)
+        if args.num_envs > 1:
+            train_vec(args, env, agent, writer)
+        else:
+            train(args, env, agent, writer)
         agent.save(model_path, checkpoint=True)
         # agent.save(args.model)
     # agent.load(args.model)
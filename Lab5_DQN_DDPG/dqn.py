@@ -3,6 +3,7 @@ __author__ = 'chengscott'
 __copyright__ = 'Copyright 2020, NCTU CGI Lab'
 import argparse
 from collections import deque
+from functools import partial
 import itertools
 import random
 import time
@@ -13,6 +14,8 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter # tensorboard --logdir=log/dqn
+from prioritized_memory import PrioritizedReplayMemory, prioritized_mse_loss
+from vec_env import SubprocVecEnv
 
 
 
@@ -29,6 +32,10 @@ class ReplayMemory:
         # (state, action, reward, next_state, done)
         self.buffer.append(tuple(map(tuple, transition)))
 
+    def extend(self, *transitions):
+        # each argument is a batch of one transition field
+        self.buffer.extend(zip(*(map(tuple, x) for x in transitions)))
+
     def sample(self, batch_size, device):
         '''sample a batch of transition tensors'''
         transitions = random.sample(self.buffer, batch_size) # Sample {$batch_size} experiences from buffer
@@ -65,7 +72,11 @@ class DQN:
         ## TODO ##
         self._optimizer = optim.Adam(self._behavior_net.parameters(), lr=args.lr)
         # memory
-        self._memory = ReplayMemory(capacity=args.capacity)
+        self._prioritized = args.prioritized
+        if self._prioritized:
+            self._memory = PrioritizedReplayMemory(capacity=args.capacity)
+        else:
+            self._memory = ReplayMemory(capacity=args.capacity)
 
         ## config ##
         self.device = args.device
@@ -91,9 +102,22 @@ class DQN:
             _, best_action_index = q_values.max(dim=1)
         return best_action_index.item()
 
+    def select_actions(self, states, epsilon, action_space):
+        '''epsilon-greedy for a batch of states in one forward pass'''
+        with torch.no_grad():
+            q_values = self._behavior_net(torch.from_numpy(states).to(self.device))
+        actions = q_values.argmax(dim=1).cpu().numpy()
+        explore = np.random.random(len(actions)) < epsilon
+        actions[explore] = np.random.randint(action_space.n, size=explore.sum())
+        return actions
+
     def append(self, state, action, reward, next_state, done):
         self._memory.append(state, [action], [reward / 10], next_state, [int(done)])
 
+    def append_batch(self, states, actions, rewards, next_states, dones):
+        self._memory.extend(states, actions[:, None], rewards[:, None] / 10, next_states,
+                            dones[:, None].astype(int))
+
     def update(self, total_steps):
         if total_steps % self.freq == 0:
             self._update_behavior_network(self.gamma)
@@ -102,7 +126,13 @@ class DQN:
 
     def _update_behavior_network(self, gamma):
         # sample a minibatch of transitions
-        state, action, reward, next_state, done = self._memory.sample(self.batch_size, self.device)
+        if self._prioritized:
+            state, action, reward, next_state, done, weights, indices = self._memory.sample(
+                self.batch_size, self.device)
+            criterion = prioritized_mse_loss(self._memory, weights, indices)
+        else:
+            state, action, reward, next_state, done = self._memory.sample(self.batch_size, self.device)
+            criterion = nn.MSELoss()
 
         ## TODO ##
         # q_value = ?
@@ -126,7 +156,6 @@ class DQN:
             q_next, _ = torch.max(q_next, dim=1)
             q_next = q_next.reshape(-1, 1) # 轉換成(batch_size, 1)
             q_target = reward + gamma * q_next * (1 - done)
-        criterion = nn.MSELoss()
         loss = criterion(q_value, q_target)
 
         # optimize
@@ -208,6 +237,58 @@ def train(args, env, agent, writer):
     env.close()
 
 
+def train_vec(args, env, agent, writer):
+    print('Start Training with {} environments'.format(args.num_envs))
+    envs = SubprocVecEnv([partial(gym.make, 'LunarLander-v2') for _ in range(args.num_envs)])
+    action_space = envs.action_space
+    total_steps, epsilon = 0, 1.
+    ewma_reward = 0
+    episode = 0
+    total_rewards = np.zeros(args.num_envs)
+    lengths = np.zeros(args.num_envs, dtype=int)
+    states = envs.reset()
+    start_time = time.time()
+    while episode < args.episode:
+        # select actions
+        if total_steps < args.warmup:
+            actions = np.array([action_space.sample() for _ in range(args.num_envs)])
+        else:
+            actions = agent.select_actions(states, epsilon, action_space)
+            epsilon = max(epsilon * args.eps_decay**args.num_envs, args.eps_min)
+
+        # execute actions
+        next_states, rewards, dones, ends = envs.step(actions)
+
+        # store transitions
+        agent.append_batch(states, actions, rewards, next_states, dones)
+
+        # keep one update per environment step
+        for _ in range(args.num_envs):
+            if total_steps >= args.warmup:
+                agent.update(total_steps)
+            total_steps += 1
+
+        states = envs.states
+        total_rewards += rewards
+        lengths += 1
+        for i in np.flatnonzero(ends):
+            ewma_reward = 0.05 * total_rewards[i] + (1 - 0.05) * ewma_reward
+            writer.add_scalar('Train/Episode Reward', total_rewards[i], total_steps)
+            writer.add_scalar('Train/Ewma Reward', ewma_reward, total_steps)
+            print(
+                'Step: {}\tEpisode: {}\tLength: {:3d}\tTotal reward: {:.2f}\tEwma reward: {:.2f}\tEpsilon: {:.3f}\tSteps/s: {:.1f}'
+                .format(total_steps, episode, lengths[i], total_rewards[i], ewma_reward, epsilon,
+                        total_steps / (time.time() - start_time)))
+            total_rewards[i], lengths[i] = 0, 0
+            episode += 1
+            if episode % 100 == 0:
+                model_path = f'model/dqn/dqn_episode={str(episode)}.pth'
+                agent.save(model_path, checkpoint=True)
+                test(args, env, agent, writer)
+    envs.close()
+    env.close()
+
+
 def test(args, env, agent, writer):
     print('Start Testing')
     action_space = env.action_space
@@ -258,6 +339,8 @@ def main():
     parser.add_argument('--gamma', default=.99, type=float)
     parser.add_argument('--freq', default=4, type=int)
     parser.add_argument('--target_freq', default=100, type=int)
+    parser.add_argument('--num_envs', default=1, type=int)
+    parser.add_argument('--prioritized', action='store_true')
     # test
     parser.add_argument('--test_only', action='store_true')
     parser.add_argument('--render', action='store_true')
@@ -270,7 +353,10 @@ def main():
     agent = DQN(args)
     writer = SummaryWriter(args.logdir)
     if not args.test_only:
-        train(args, env, agent, writer)
+        if args.num_envs > 1:
+            train_vec(args, env, agent, writer)
+        else:
+            train(args, env, agent, writer)
         new_model_path = f"model/dqn/dqn_ep={args.episode}.pth"
         agent.save(new_model_path) # new model
 
@@ -2,7 +2,6 @@
 __author__ = 'chengscott'
 __copyright__ = 'Copyright 2020, NCTU CGI Lab'
 import argparse
-from collections import deque
 import itertools
 import random
 import time
@@ -10,30 +9,189 @@ import time
 import gym
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
 from torch.utils.tensorboard import SummaryWriter
 from atari_wrappers import wrap_deepmind, make_atari
+from vec_env import SubprocVecEnv
 
 
-class ReplayMemory(object):
-    ## TODO ##
-    def __init__(self, capacity):
-        self.buffer = deque(maxlen=capacity)       
+# emulator frames per agent step, the skip of MaxAndSkipEnv in atari_wrappers.make_atari
+FRAME_SKIP = 4
+
 
-    def push(self, *transition):
+class ReplayMemory(object):
+    '''Circular replay buffer backed by preallocated uint8 arrays
+
+    next_state shares all but its newest frame with state, so only that frame
+    is stored and the next_state stack is rebuilt at sample time: 5 frames,
+    about 35 KB, per transition.
+    '''
+    def __init__(self, capacity, state_shape=(4, 84, 84)):
+        self.capacity = capacity
+        self.position = 0
+        self.size = 0
+        # np.empty only reserves the pages, they are committed as the ring fills
+        self.states = np.empty((capacity, *state_shape), dtype=np.uint8)
+        self.next_frames = np.empty((capacity, *state_shape[1:]), dtype=np.uint8)
+        self.actions = np.empty((capacity, 1), dtype=np.int64)
+        self.rewards = np.empty((capacity, 1), dtype=np.float32)
+        self.dones = np.empty((capacity, 1), dtype=np.float32)
+
+    def push(self, state, action, reward, next_state, done):
         """Saves a transition"""
-        self.buffer.append(tuple(map(tuple, transition)))
+        # LazyFrames are (84, 84, 4), store them channel-first for the network
+        self.states[self.position] = np.asarray(state).transpose(2, 0, 1)
+        self.next_frames[self.position] = np.asarray(next_state)[..., -1]
+        self.actions[self.position] = action
+        self.rewards[self.position] = reward
+        self.dones[self.position] = done
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def push_batch(self, states, actions, rewards, next_states, dones, ends=None):
+        """Saves a batch of transitions, e.g. one step of every environment.
+        ends is accepted like FrameReplayMemory's, whole stacks never span two episodes"""
+        n = len(actions)
+        slots = (self.position + np.arange(n)) % self.capacity
+        self.states[slots] = np.asarray(states).transpose(0, 3, 1, 2)
+        self.next_frames[slots] = np.asarray(next_states)[..., -1]
+        self.actions[slots, 0] = actions
+        self.rewards[slots, 0] = rewards
+        self.dones[slots, 0] = dones
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
 
     def sample(self, batch_size, device):
         """Sample a batch of transitions"""
-        transitions = random.sample(self.buffer, batch_size)
-        return (torch.tensor(np.array(x), dtype=torch.float, device=device)
-                for x in zip(*transitions))
+        indices = np.random.randint(0, self.size, size=batch_size)
+        states = self.states[indices]
+        next_states = np.concatenate([states[:, 1:], self.next_frames[indices, None]], axis=1)
+        return (self._to_device(x, device)
+                for x in (states, self.actions[indices], self.rewards[indices], next_states, self.dones[indices]))
+
+    @staticmethod
+    def _to_device(array, device):
+        tensor = torch.from_numpy(array)
+        if torch.device(device).type == 'cuda':
+            tensor = tensor.pin_memory()
+        return tensor.to(device, non_blocking=True)
 
     def __len__(self):
         return self.size
 
 
+class FrameReplayMemory(object):
+    '''Replay buffer that stores every 84x84 frame once
+
+    Frames live in a ring per stream (one stream per environment). Slot i
+    holds the newest frame of a next_state, so the transition ending at slot
+    i uses frames i-4..i-1 as state and i-3..i as next_state. At the start of
+    an episode the whole first stack is written, with those slots flagged as
+    not being the end of a transition, so sampled stacks never cross an
+    episode boundary.
+
+    All bookkeeping is kept per stream, so after share_memory() one process
+    per stream can push while another one samples.
+    '''
+    _BUFFERS = ('positions', 'sizes', 'counts', 'new_episode',
+                'frames', 'actions', 'rewards', 'dones', 'valid')
+
+    def __init__(self, capacity, frame_shape=(84, 84), history=4, num_streams=1):
+        self.num_streams = num_streams
+        self.capacity = capacity // num_streams
+        self.history = history
+        self._shared = None
+        self.positions = np.zeros(num_streams, dtype=np.int64)
+        self.sizes = np.zeros(num_streams, dtype=np.int64)
+        self.counts = np.zeros(num_streams, dtype=np.int64)
+        self.new_episode = np.ones(num_streams, dtype=bool)
+        self.frames = np.empty((num_streams, self.capacity, *frame_shape), dtype=np.uint8)
+        self.actions = np.empty((num_streams, self.capacity, 1), dtype=np.int64)
+        self.rewards = np.empty((num_streams, self.capacity, 1), dtype=np.float32)
+        self.dones = np.empty((num_streams, self.capacity, 1), dtype=np.float32)
+        # True where the slot is the last frame of a complete transition
+        self.valid = np.zeros((num_streams, self.capacity), dtype=bool)
+
+    def share_memory(self):
+        """Moves the buffers into shared memory, they stay shared when the
+        memory is passed to a torch.multiprocessing process"""
+        self._shared = {name: torch.from_numpy(getattr(self, name)).share_memory_()
+                        for name in self._BUFFERS}
+        for name, tensor in self._shared.items():
+            setattr(self, name, tensor.numpy())
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shared is not None:
+            # rebuilt as views of the shared tensors on the other side
+            for name in self._BUFFERS:
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            for name, tensor in self._shared.items():
+                setattr(self, name, tensor.numpy())
+
+    def _write(self, streams, frames):
+        slots = self.positions[streams]
+        self.frames[streams, slots] = frames
+        # transitions ending in the next `history` slots reach back to this one
+        stale = (slots[:, None] + np.arange(self.history + 1)) % self.capacity
+        self.counts[streams] -= self.valid[streams[:, None], stale].sum(axis=1)
+        self.valid[streams[:, None], stale] = False
+        self.positions[streams] = (slots + 1) % self.capacity
+        self.sizes[streams] = np.minimum(self.sizes[streams] + 1, self.capacity)
+        return slots
+
+    def push(self, state, action, reward, next_state, done, stream=0):
+        """Saves a transition"""
+        self.push_batch(np.asarray(state)[None], [action], [reward],
+                        np.asarray(next_state)[None], [done], streams=[stream])
+
+    def push_batch(self, states, actions, rewards, next_states, dones, streams=None, ends=None):
+        """Saves one transition for each of the given (distinct) streams.
+        ends marks the streams whose episode ended, by termination or truncation, and
+        defaults to dones; the next push of those streams starts a new stack"""
+        streams = np.arange(self.num_streams) if streams is None else np.asarray(streams)
+        starting = self.new_episode[streams]
+        if starting.any():
+            first = np.asarray(states)[starting]
+            for k in range(self.history):
+                self._write(streams[starting], first[..., k])
+        slots = self._write(streams, np.asarray(next_states)[..., -1])
+        self.actions[streams, slots, 0] = actions
+        self.rewards[streams, slots, 0] = rewards
+        self.dones[streams, slots, 0] = dones
+        self.valid[streams, slots] = True
+        self.counts[streams] += 1
+        self.new_episode[streams] = np.asarray(dones if ends is None else ends, dtype=bool)
+
+    def sample(self, batch_size, device):
+        """Sample a batch of transitions"""
+        streams = np.empty(0, dtype=np.int64)
+        slots = np.empty(0, dtype=np.int64)
+        while len(slots) < batch_size:
+            s = np.random.randint(0, self.num_streams, size=batch_size)
+            i = (np.random.random(batch_size) * self.sizes[s]).astype(np.int64)
+            keep = self.valid[s, i]
+            streams = np.concatenate([streams, s[keep]])
+            slots = np.concatenate([slots, i[keep]])
+        streams, slots = streams[:batch_size], slots[:batch_size]
+        # (batch, history + 1, 84, 84): state and next_state overlap in all but one frame
+        stacks = self.frames[streams[:, None],
+                             (slots[:, None] + np.arange(-self.history, 1)) % self.capacity]
+        return (ReplayMemory._to_device(x, device)
+                for x in (stacks[:, :-1], self.actions[streams, slots], self.rewards[streams, slots],
+                          stacks[:, 1:], self.dones[streams, slots]))
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+
 class Net(nn.Module):
     def __init__(self, num_classes=4, init_weights=True):
         super(Net, self).__init__()
@@ -84,7 +242,12 @@ class DQN:
 
         ## TODO ##
         """Initialize replay buffer"""
-        self._memory = ReplayMemory(capacity=args.capacity)
+        if args.memory == 'frame':
+            # one stream per environment, or per actor process in async mode
+            self._memory = FrameReplayMemory(capacity=args.capacity,
+                                             num_streams=args.num_actors or args.num_envs)
+        else:
+            self._memory = ReplayMemory(capacity=args.capacity)
 
         ## config ##
         self.device = args.device
@@ -122,10 +285,24 @@ class DQN:
         #         action = self._behavior_net(state).max(1)[1].to('cpu').view(1, 1)
         #         return action.numpy()[0, 0].item()
 
+    def select_actions(self, states, epsilon, action_space):
+        '''epsilon-greedy for a batch of (N, 84, 84, 4) states in one forward pass'''
+        with torch.no_grad():
+            q_values = self._behavior_net(torch.from_numpy(states).permute(0, 3, 1, 2).to(self.device))
+        actions = q_values.argmax(dim=1).cpu().numpy()
+        explore = np.random.random(len(actions)) < epsilon
+        actions[explore] = np.random.randint(action_space.n, size=explore.sum())
+        return actions
+
     def append(self, state, action, reward, next_state, done):
         ## TODO ##
         """Push a transition into replay buffer"""
-        self._memory.push(state, [action], [reward], next_state, [int(done)])
+        self._memory.push(state, action, reward, next_state, int(done))
+
+    def append_batch(self, states, actions, rewards, next_states, dones, ends=None):
+        """Push one transition per environment into replay buffer, dones masks the
+        bootstrap and ends (default dones) also covers truncated episodes"""
+        self._memory.push_batch(states, actions, rewards, next_states, dones.astype(int), ends=ends)
 
     def update(self, total_steps):
         if total_steps % self.freq == 0:
@@ -138,18 +315,9 @@ class DQN:
         state, action, reward, next_state, done = self._memory.sample(self.batch_size, self.device)
 
         ## TODO ##
-        state = state.permute(0, 3, 1, 2)
-        # state = state.repeat(1, 4, 1, 1).to(self.device)
-        # print("State shape:", state.shape)
-
-        next_state = next_state.permute(0, 3, 1, 2)
-        # next_state = next_state.repeat(1, 4, 1, 1).to(self.device)
-        # print("Next state shape:", next_state.shape)
-
-        # q_value = self._behavior_net(state).gather(1, action.long())
-
-        # -----------------------------------------------------------------------
-        q_value = self._behavior_net(state).gather(1, action.long())
+        # states come out of the replay memory as (batch, 4, 84, 84) uint8,
+        # Net.forward takes care of the float conversion on the device
+        q_value = self._behavior_net(state).gather(1, action)
         with torch.no_grad():
             q_next = self._target_net(next_state).max(dim=1).values.view(-1, 1)
             q_target = reward + gamma * q_next * (1.0 - done)
@@ -251,6 +419,156 @@ def train(args, agent, writer):
     env.close()
 
 
+def make_env(episode_life=True, clip_rewards=True, frame_stack=True):
+    env_raw = make_atari('BreakoutNoFrameskip-v4')
+    return wrap_deepmind(env_raw, episode_life=episode_life, clip_rewards=clip_rewards,
+                         frame_stack=frame_stack)
+
+
+def train_vec(args, agent, writer):
+    print('Start Training with {} environments'.format(args.num_envs))
+    envs = SubprocVecEnv([make_env] * args.num_envs)
+    action_space = envs.action_space
+    total_steps, epsilon = 0, 1.
+    ewma_reward = 0
+    episode = 0
+    total_rewards = np.zeros(args.num_envs)
+    lengths = np.zeros(args.num_envs, dtype=int)
+    states = envs.reset()
+    start_time = time.time()
+    while episode < args.episode:
+        if total_steps < args.warmup:
+            actions = np.array([action_space.sample() for _ in range(args.num_envs)])
+        else:
+            # select actions
+            actions = agent.select_actions(states, epsilon, action_space)
+            # decay epsilon
+            epsilon -= args.num_envs * (1 - args.eps_min) / args.eps_decay
+            epsilon = max(epsilon, args.eps_min)
+
+        # execute actions
+        next_states, rewards, dones, ends = envs.step(actions)
+
+        # store transitions
+        agent.append_batch(states, actions, rewards, next_states, dones, ends)
+
+        # keep one update per environment step
+        for _ in range(args.num_envs):
+            if total_steps >= args.warmup:
+                agent.update(total_steps)
+            total_steps += 1
+
+            if total_steps % args.eval_freq == 0:
+                test(args, agent, writer)
+                agent.save(args.model + "dqn_breakout_" + str(total_steps) + ".pt")
+
+        states = envs.states
+        total_rewards += rewards
+        lengths += 1
+        for i in np.flatnonzero(ends):
+            ewma_reward = 0.05 * total_rewards[i] + (1 - 0.05) * ewma_reward
+            writer.add_scalar('Train/Episode Reward', total_rewards[i], episode)
+            writer.add_scalar('Train/Ewma Reward', ewma_reward, episode)
+            print('Step: {}\tEpisode: {}\tLength: {:3d}\tTotal reward: {:.2f}\tEwma reward: {:.2f}\tEpsilon: {:.3f}\tSteps/s: {:.1f}'
+                    .format(total_steps, episode, lengths[i], total_rewards[i], ewma_reward, epsilon,
+                            total_steps / (time.time() - start_time)))
+            total_rewards[i], lengths[i] = 0, 0
+            episode += 1
+    envs.close()
+
+
+def actor(index, args, net, memory, steps, episodes, stop):
+    '''collect transitions into stream `index` of the shared replay memory,
+    acting with the shared CPU copy of the behavior network'''
+    torch.set_num_threads(1)
+    env = make_env()
+    action_space = env.action_space
+    state = env.reset()
+    total_reward = 0
+    for t in itertools.count(start=1):
+        if stop.is_set():
+            break
+        with steps.get_lock():
+            total_steps = steps.value
+            steps.value += 1
+        epsilon = max(1 - total_steps * (1 - args.eps_min) / args.eps_decay, args.eps_min)
+        if total_steps < args.warmup or random.random() < epsilon:
+            action = action_space.sample()
+        else:
+            with torch.no_grad():
+                state_tensor = torch.from_numpy(np.asarray(state)).permute(2, 0, 1).unsqueeze(0)
+                action = net(state_tensor).argmax(dim=1).item()
+
+        next_state, reward, done, _ = env.step(action)
+        memory.push(state, action, reward, next_state, int(done), stream=index)
+        state = next_state
+        total_reward += reward
+
+        if done:
+            with episodes.get_lock():
+                episode = episodes.value
+                episodes.value += 1
+            print('Actor: {}\tStep: {}\tEpisode: {}\tLength: {:3d}\tTotal reward: {:.2f}\tEpsilon: {:.3f}'
+                    .format(index, total_steps, episode, t, total_reward, epsilon))
+            if episode + 1 >= args.episode:
+                stop.set()
+            state = env.reset()
+            total_reward = 0
+    env.close()
+
+
+def train_async(args, agent, writer):
+    '''actor processes step the environments while this process keeps updating'''
+    print('Start Training with {} actors'.format(args.num_actors))
+    ctx = mp.get_context('spawn')
+    memory = agent._memory.share_memory()
+    # actors act with a shared CPU copy, refreshed in place every sync_freq updates
+    net = Net(init_weights=False)
+    net.load_state_dict(agent._behavior_net.state_dict())
+    net.eval()
+    net.share_memory()
+    steps, episodes, stop = ctx.Value('l', 0), ctx.Value('l', 0), ctx.Event()
+    actors = [ctx.Process(target=actor, args=(i, args, net, memory, steps, episodes, stop), daemon=True)
+              for i in range(args.num_actors)]
+    for process in actors:
+        process.start()
+
+    updates = 0
+    next_save = args.eval_freq
+    report_time, report_steps, report_updates = time.time(), 0, 0
+    while not stop.is_set():
+        if steps.value < args.warmup:
+            time.sleep(0.1)
+            continue
+        agent._update_behavior_network(agent.gamma)
+        updates += 1
+        # target_freq and sync_freq count environment steps like in train()
+        if updates % max(args.target_freq // args.freq, 1) == 0:
+            agent._update_target_network()
+        if updates % max(args.sync_freq // args.freq, 1) == 0:
+            net.load_state_dict(agent._behavior_net.state_dict())
+
+        if steps.value >= next_save:
+            agent.save(args.model + "dqn_breakout_" + str(steps.value) + ".pt")
+            next_save += args.eval_freq
+
+        now = time.time()
+        if now - report_time >= args.report_freq:
+            total_steps = steps.value
+            steps_per_sec = (total_steps - report_steps) / (now - report_time)
+            updates_per_sec = (updates - report_updates) / (now - report_time)
+            frames_per_sec = steps_per_sec * FRAME_SKIP
+            writer.add_scalar('Train/Env Frames per Second', frames_per_sec, total_steps)
+            writer.add_scalar('Train/Env Steps per Second', steps_per_sec, total_steps)
+            writer.add_scalar('Train/Learner Updates per Second', updates_per_sec, total_steps)
+            print('Step: {}\tUpdates: {}\tEnv frames/s: {:.1f}\tEnv steps/s: {:.1f}\tLearner updates/s: {:.1f}'
+                    .format(total_steps, updates, frames_per_sec, steps_per_sec, updates_per_sec))
+            report_time, report_steps, report_updates = now, total_steps, updates
+
+    for process in actors:
+        process.join()
+
+
 def test(args, agent, writer):
     print('Start Testing')
     env_raw = make_atari('BreakoutNoFrameskip-v4')
@@ -290,6 +608,9 @@ def main():
     parser.add_argument('--warmup', default=20000, type=int)
     parser.add_argument('--episode', default=20001, type=int)
     parser.add_argument('--capacity', default=100000, type=int)
+    parser.add_argument('--memory', default='frame', choices=['frame', 'array'],
+                        help="frame stores every frame once (about 7 KB per transition), "
+                             "array the state stack and the newest next frame (about 35 KB per transition)")
     parser.add_argument('--batch_size', default=32, type=int)
     parser.add_argument('--lr', default=0.0000625, type=float)
     parser.add_argument('--eps_decay', default=1000000, type=float)
@@ -298,6 +619,11 @@ def main():
     parser.add_argument('--freq', default=4, type=int)
     parser.add_argument('--target_freq', default=10000, type=int)
     parser.add_argument('--eval_freq', default=200000, type=int)
+    parser.add_argument('--num_envs', default=1, type=int)
+    # asynchronous actor/learner
+    parser.add_argument('--num_actors', default=0, type=int)
+    parser.add_argument('--sync_freq', default=400, type=int)
+    parser.add_argument('--report_freq', default=10, type=float)
     # test
     parser.add_argument('--test_only', action='store_true')
     parser.add_argument('-tmp', '--test_model_path', default='model/dqn_breakout/dqn_breakout_1000000.pt')
@@ -306,6 +632,8 @@ def main():
     parser.add_argument('--seed', default=20230822, type=int)
     parser.add_argument('--test_epsilon', default=0.01, type=float)
     args = parser.parse_args()
+    if args.num_actors and args.memory != 'frame':
+        parser.error('--num_actors needs the shared frame replay memory (--memory frame)')
 
     ## main ##
     agent = DQN(args)
@@ -313,6 +641,10 @@ def main():
     if args.test_only:
         agent.load(args.test_model_path)
         test(args, agent, writer)
+    elif args.num_actors > 0:
+        train_async(args, agent, writer)
+    elif args.num_envs > 1:
+        train_vec(args, agent, writer)
     else:
         train(args, agent, writer)
         
@@ -15,6 +15,7 @@ import torch.nn.functional as F
 from collections import namedtuple
 from torch.utils.tensorboard import SummaryWriter
 from atari_wrappers import wrap_deepmind, make_atari
+from prioritized_memory import PrioritizedReplayMemory, prioritized_mse_loss, to_tensors
 
 Transition = namedtuple('Transition', 
                         ('state', 'action', 'reward', 'next_state', 'done'))
@@ -34,8 +35,9 @@ class ReplayMemory(object):
         self._memory[self._position] = Transition(*kargs)
         self._position = (self._position+1) % self._capacity 
 
-    def sample(self, batch_size):
-        return random.sample(self._memory, batch_size)
+    def sample(self, batch_size, device):
+        '''sample a batch of transition tensors'''
+        return to_tensors(random.sample(self._memory, batch_size), device)
     
     def __len__(self):
         return len(self._memory)
@@ -94,7 +96,11 @@ class DQN:
 
         ## TODO ##
         """Initialize replay buffer"""
-        self._memory = ReplayMemory(capacity=args.capacity)
+        self._prioritized = args.prioritized
+        if self._prioritized:
+            self._memory = PrioritizedReplayMemory(capacity=args.capacity)
+        else:
+            self._memory = ReplayMemory(capacity=args.capacity)
 
         ## config ##
         self.device = args.device
@@ -124,7 +130,8 @@ class DQN:
     def append(self, state, action, reward, next_state, done):
         ## TODO ##
         """Push a transition into replay buffer"""
-        self._memory.push(state, action, reward, next_state, done)
+        # select_action may return a tensor on the device, the memory keeps plain ints
+        self._memory.push(state, int(action), reward, next_state, done)
 
     def update(self, total_steps):
         if total_steps % self.freq == 0:
@@ -134,22 +141,21 @@ class DQN:
 
     def _update_behavior_network(self, gamma):
         # sample a minibatch of transitions
-        transitions = self._memory.sample(self.batch_size)
+        if self._prioritized:
+            state_batch, action_batch, reward_batch, next_s_batch, done_batch, weights, indices = \
+                self._memory.sample(self.batch_size, self.device)
+            criterion = prioritized_mse_loss(self._memory, weights, indices)
+        else:
+            state_batch, action_batch, reward_batch, next_s_batch, done_batch = \
+                self._memory.sample(self.batch_size, self.device)
+            criterion = F.mse_loss
 
         ## TODO ##
-        batch = Transition(*zip(*transitions))
-        
-        state_batch = torch.tensor(np.array(batch.state,dtype=np.float32),device=self.device,dtype=torch.float32).to(self.device)
-        action_batch = torch.tensor(batch.action,device=self.device).unsqueeze(1).to(self.device)
-        reward_batch = torch.tensor(batch.reward,device=self.device,dtype=torch.float32).unsqueeze(1).to(self.device)
-        next_s_batch = torch.tensor(np.array(batch.next_state,dtype=np.float32),device=self.device,dtype=torch.float32).to(self.device)
-        done_batch = torch.tensor(np.array(batch.done,dtype=np.float32),device = self.device,dtype=torch.float32).unsqueeze(1).to(self.device)
-
         q_value = self._behavior_net(state_batch.squeeze()).gather(dim=1, index=action_batch.long())
         with torch.no_grad():
             q_next = self._target_net(next_s_batch.squeeze()).max(dim=1)[0].detach().unsqueeze(1)
             q_target = reward_batch + gamma*q_next*(1-done_batch)
-        loss = F.mse_loss(q_value, q_target)
+        loss = criterion(q_value, q_target)
 
         self._optimizer.zero_grad()
         loss.backward()
@@ -288,6 +294,7 @@ def main():
     parser.add_argument('--freq', default=4, type=int)
     parser.add_argument('--target_freq', default=10000, type=int)
     parser.add_argument('--eval_freq', default=500000, type=int)
+    parser.add_argument('--prioritized', action='store_true')
     # test
     parser.add_argument('--test_only', action='store_true')
     parser.add_argument('-tmp', '--test_model_path', default='model/dqn_breakout2/dqn_10500000.pt')
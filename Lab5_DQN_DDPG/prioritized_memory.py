@@ -0,0 +1,120 @@
+'''Proportional prioritized experience replay (Schaul et al., 2016)'''
+import numpy as np
+import torch
+
+
+def to_tensors(transitions, device):
+    '''float32 tensor of every field of a list of transitions, scalar fields as (batch, 1)'''
+    for x in zip(*transitions):
+        tensor = torch.tensor(np.array(x, dtype=np.float32), device=device)
+        yield tensor.view(-1, 1) if tensor.dim() == 1 else tensor
+
+
+def prioritized_mse_loss(memory, weights, indices):
+    '''criterion(q_value, q_target) for a batch sampled from a PrioritizedReplayMemory
+
+    The MSE is weighted by the importance-sampling weights of the batch, and the
+    TD errors of the same batch become its new priorities.
+    '''
+    def criterion(q_value, q_target):
+        td_error = q_target - q_value
+        memory.update_priorities(indices, td_error.detach().abs().view(-1).cpu().numpy())
+        return (weights * td_error.pow(2)).mean()
+    return criterion
+
+
+class SumTree:
+    '''Binary sum tree over the priorities, stored in one flat array
+
+    Node i has children 2i and 2i+1, the root is node 1 and leaf j lives at
+    node `size + j`. The leaf count is rounded up to a power of two so every
+    leaf has the same depth; the padding leaves keep priority 0.
+    '''
+    def __init__(self, capacity):
+        self.depth = max(1, (capacity - 1).bit_length())
+        self.size = 1 << self.depth
+        self.tree = np.zeros(2 * self.size)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.size]
+
+    def update(self, indices, priorities):
+        '''set the priorities of a batch of leaves, O(batch * log n)'''
+        nodes = np.asarray(indices) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        '''leaf index for each prefix-sum value, O(batch * log n)'''
+        values = np.asarray(values, dtype=np.float64).copy()
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.size
+
+
+class PrioritizedReplayMemory:
+    '''Replay buffer that samples transitions proportionally to |TD error|^alpha
+
+    push/append/extend, __len__ and sample(batch_size, device) match the uniform
+    ReplayMemory of the agents. sample returns the same transition tensors followed
+    by the importance-sampling weights, as a (batch, 1) tensor, and the indices of
+    the batch; prioritized_mse_loss turns both into the criterion of the update.
+    '''
+    def __init__(self, capacity, alpha=.6, beta=.4, beta_increment=1e-4, eps=1e-6):
+        self._capacity = capacity
+        self._memory = []
+        self._position = 0
+        self._tree = SumTree(capacity)
+        self._max_priority = 1.
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+
+    def __len__(self):
+        return len(self._memory)
+
+    def push(self, *transition):
+        self.extend(*([x] for x in transition))
+
+    append = push
+
+    def extend(self, *transitions):
+        '''each argument is a batch of one transition field'''
+        transitions = list(zip(*transitions))
+        indices = (self._position + np.arange(len(transitions))) % self._capacity
+        for index, transition in zip(indices, transitions):
+            if index == len(self._memory):
+                self._memory.append(transition)
+            else:
+                self._memory[index] = transition
+        # new transitions are replayed at least once
+        self._tree.update(indices, self._max_priority)
+        self._position = (self._position + len(transitions)) % self._capacity
+
+    def sample(self, batch_size, device):
+        # stratified: one draw from each of batch_size equal slices of the total
+        segment = self._tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        indices = np.minimum(self._tree.find(values), len(self._memory) - 1)
+        probs = self._tree[indices] / self._tree.total
+        weights = (len(self._memory) * probs)**-self.beta
+        weights /= weights.max()
+        self.beta = min(1., self.beta + self.beta_increment)
+        weights = torch.from_numpy(weights.astype(np.float32)).to(device).view(-1, 1)
+        return (*to_tensors([self._memory[i] for i in indices], device), weights, indices)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = (np.abs(td_errors) + self.eps)**self.alpha
+        self._tree.update(indices, priorities)
+        self._max_priority = max(self._max_priority, priorities.max())
@@ -0,0 +1,113 @@
+'''Run several gym environments in worker processes
+
+Observations are exchanged through shared memory, only actions, rewards and
+done flags go through the pipes. Environments reset themselves when an
+episode ends, so `states` is always ready for the next batched action.
+'''
+import multiprocessing as mp
+
+import numpy as np
+
+
+def _reset(env):
+    ob = env.reset()
+    # gym>=0.26 returns (obs, info)
+    if isinstance(ob, tuple):
+        ob = ob[0]
+    return ob
+
+
+def _step(env, action):
+    '''return (obs, reward, terminal, episode_end) for both gym step APIs'''
+    result = env.step(action)
+    if len(result) == 5:
+        ob, reward, terminated, truncated, _ = result
+        return ob, reward, terminated, terminated or truncated
+    ob, reward, done, _ = result
+    return ob, reward, done, done
+
+
+def _worker(remote, env_fn, index, states_buf, next_states_buf, shape, dtype):
+    env = env_fn()
+    states = np.frombuffer(states_buf, dtype=dtype).reshape(-1, *shape)
+    next_states = np.frombuffer(next_states_buf, dtype=dtype).reshape(-1, *shape)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                ob, reward, terminal, end = _step(env, data)
+                next_states[index] = np.asarray(ob)
+                if end:
+                    ob = _reset(env)
+                states[index] = np.asarray(ob)
+                remote.send((reward, terminal, end))
+            elif cmd == 'reset':
+                states[index] = np.asarray(_reset(env))
+                remote.send(None)
+            elif cmd == 'close':
+                break
+    finally:
+        env.close()
+        remote.close()
+
+
+class SubprocVecEnv:
+    def __init__(self, env_fns, start_method='spawn'):
+        '''env_fns must be picklable, e.g. functools.partial(gym.make, env_id).
+        spawn keeps CUDA state of the parent out of the workers.'''
+        self.num_envs = len(env_fns)
+        probe = env_fns[0]()
+        self.observation_space = probe.observation_space
+        self.action_space = probe.action_space
+        probe.close()
+
+        shape = self.observation_space.shape
+        dtype = np.dtype(self.observation_space.dtype)
+        nbytes = self.num_envs * int(np.prod(shape)) * dtype.itemsize
+        ctx = mp.get_context(start_method)
+        self._states_buf = ctx.RawArray('B', nbytes)
+        self._next_states_buf = ctx.RawArray('B', nbytes)
+        self._states = np.frombuffer(self._states_buf, dtype=dtype).reshape(self.num_envs, *shape)
+        self._next_states = np.frombuffer(self._next_states_buf, dtype=dtype).reshape(self.num_envs, *shape)
+
+        self._remotes, self._processes = [], []
+        for index, env_fn in enumerate(env_fns):
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker,
+                                  args=(work_remote, env_fn, index, self._states_buf,
+                                        self._next_states_buf, shape, dtype.str),
+                                  daemon=True)
+            process.start()
+            work_remote.close()
+            self._remotes.append(remote)
+            self._processes.append(process)
+
+    @property
+    def states(self):
+        '''current observations, already reset where an episode has ended'''
+        return self._states.copy()
+
+    def reset(self):
+        for remote in self._remotes:
+            remote.send(('reset', None))
+        for remote in self._remotes:
+            remote.recv()
+        return self.states
+
+    def step(self, actions):
+        '''return (next_states, rewards, terminals, episode_ends)
+
+        next_states are the true successors of the stepped states, also for
+        environments that have been reset since.
+        '''
+        for remote, action in zip(self._remotes, actions):
+            remote.send(('step', action))
+        rewards, terminals, ends = zip(*(remote.recv() for remote in self._remotes))
+        return (self._next_states.copy(), np.array(rewards, dtype=np.float32),
+                np.array(terminals, dtype=bool), np.array(ends, dtype=bool))
+
+    def close(self):
+        for remote in self._remotes:
+            remote.send(('close', None))
+        for process in self._processes:
+            process.join()
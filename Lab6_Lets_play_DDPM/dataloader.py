@@ -3,13 +3,68 @@ from PIL import Image
 from torch.utils import data
 import torch
 import json
-from sklearn.preprocessing import LabelBinarizer
 import numpy as np
 import os
+import hashlib
 from torchvision import transforms
 from torchvision.utils import save_image
 
 
+def encode_labels(objects, obj_dict, num_classes=24):
+    """(N, num_classes) multi-hot matrix of the object names of every image, built in one pass"""
+    lengths = [len(value) for value in objects]
+    rows = np.repeat(np.arange(len(objects)), lengths)
+    cols = np.fromiter((obj_dict[name] for value in objects for name in value), dtype=np.int64, count=len(rows))
+    labels = np.zeros((len(objects), num_classes), dtype=np.int64)
+    np.add.at(labels, (rows, cols), 1) # an object listed twice counts twice, like summing one-hot rows
+    return labels
+
+
+def json_digest(root, mode):
+    """short hash of objects.json and <mode>.json, used to key the .npy caches"""
+    digest = hashlib.sha1()
+    for path in (root + 'objects.json', root + mode + '.json'):
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+def save_npy(path, array):
+    # write next to the target and rename, so a crashed run never leaves half a cache
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+def load_labels(root, mode, objects, obj_dict):
+    """
+    Multi-hot labels of a split, cached as <root>/<mode>_labels_<hash>.npy where the hash
+    covers objects.json and <mode>.json, and memory-mapped on later runs.
+    """
+    cache_path = os.path.join(root, f'{mode}_labels_{json_digest(root, mode)}.npy')
+    if not os.path.exists(cache_path):
+        save_npy(cache_path, encode_labels(objects, obj_dict))
+    return np.load(cache_path, mmap_mode='r')
+
+
+def pack_images(root, img_name, size=64):
+    """
+    Decode and resize every training image once into <root>/train_images_<size>_<hash>.npy,
+    one contiguous (N, 3, size, size) uint8 array in the order of train.json.
+    Returns the path of the packed file.
+    """
+    cache_path = os.path.join(root, f'train_images_{size}_{json_digest(root, "train")}.npy')
+    if not os.path.exists(cache_path):
+        resize = transforms.Resize([size, size])
+        images = np.empty((len(img_name), 3, size, size), dtype=np.uint8)
+        for i, name in enumerate(img_name):
+            img = Image.open(os.path.join(root, "iclevr", name)).convert('RGB')
+            images[i] = np.asarray(resize(img)).transpose(2, 0, 1)
+        save_npy(cache_path, images)
+    return cache_path
+
+
 def getData(root, mode):
     obj_path = root + 'objects.json'
     with open(obj_path) as file:
@@ -19,68 +74,66 @@ def getData(root, mode):
     with open(data_path) as file:
         data = json.load(file)
 
-    lb = LabelBinarizer()
-    lb.fit([i for i in range(24)])
-    
     if mode == 'train':
-        img_name = []
-        labels = []
-        for key, value in data.items():
-            img_name.append(key) # "CLEVR_train_002066_2.png"
-            tmp = []
-            for i in range(len(value)): # ["cyan cube", "cyan sphere", "brown cylinder"]
-                tmp.append(np.array(lb.transform([obj_dict[value[i]]]))) # "brown cylinder" -> 第2類 -> [0,0,...,0,,1,0,0]  
-            labels.append((np.sum(tmp, axis=0))) # axis = 0, 對每個tmp的row vector進行element-wise的相加
+        img_name = list(data.keys()) # "CLEVR_train_002066_2.png"
+        # ["cyan cube", "cyan sphere", "brown cylinder"] -> [0,...,1,...,1,...,1,...,0]
+        labels = load_labels(root, mode, list(data.values()), obj_dict)
         # print("train_img_name:", len(img_name)) # 18009
-        # print("train_label:", len(label)) # 18009
-        labels = torch.tensor(np.array(labels))
-        # print("label[0]:", label[0])
-        # label[0]: tensor([[0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=torch.int32)
         return img_name, labels
     
     elif mode == 'test' or mode == 'new_test':
-        labels = []
-        for value in data:
-            tmp = []
-            for i in range(len(value)):
-                tmp.append(np.array(lb.transform([obj_dict[value[i]]])))
-            labels.append(np.sum(tmp, axis=0))
-        # print("test_label:", len(label))
-        labels = torch.tensor(np.array(labels))
+        labels = load_labels(root, mode, data, obj_dict)
         return labels
 
     
 
 class iclevrLoader(data.Dataset):
-    def __init__(self, root, mode, partial =1.0):
+    def __init__(self, root, mode, partial =1.0, packed=False):
         self.root = root # ./dataset
         self.mode = mode 
         self.partial = partial
+        # packed: read 64x64 uint8 images from pack_images and leave the
+        # [0, 255] -> [-1, 1] normalization to the training device
+        self.packed_path = None
+        self._packed = None
         
         if mode == 'train':
             self.img_name, self.label = getData(root, mode)
+            if packed:
+                self.packed_path = pack_images(root, self.img_name)
         elif mode == 'test' or mode == 'new_test':
             self.label = getData(root, mode)  
 
+        self.transform = transforms.Compose([
+            transforms.Resize([64, 64]), 
+            transforms.ToTensor(),
+            transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5)),
+        ])
+
+    def __getstate__(self):
+        # DataLoader workers map the packed file themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state['_packed'] = None
+        return state
+
     def __len__(self):
         """'return the size of dataset"""
         return int(len(self.label) * self.partial)
 
     def __getitem__(self, index):        
-        if self.mode == 'train':
+        if self.mode == 'train' and self.packed_path is not None:
+            if self._packed is None:
+                # copy-on-write mapping, so torch gets a writable array without copying
+                self._packed = np.load(self.packed_path, mmap_mode='c')
+            img = torch.from_numpy(self._packed[index])
+        elif self.mode == 'train':
             img_path = os.path.join(self.root, "iclevr", self.img_name[index])
             img = Image.open(img_path).convert('RGB')
-
-            transform=transforms.Compose([
-                transforms.Resize([64, 64]), 
-                transforms.ToTensor(),
-                transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5)),
-            ])
-            img = transform(img)
+            img = self.transform(img)
         else:
             img = torch.ones(1)
         
-        label = self.label[index]
+        label = torch.from_numpy(np.array(self.label[index])) # copy the row out of the read-only mmap
         return img, label
     
 def save_images(images, name):
@@ -0,0 +1,74 @@
+import contextlib
+
+import torch
+
+'''===============================================================
+Exponential moving average of the UNet weights.
+
+The shadow weights are a flat list of float32 tensors, one per model
+parameter, updated in place with the fused _foreach ops, so no
+state_dict is rebuilt during training. They can live on the cpu
+(device='cpu') to keep accelerator memory free; the parameters are
+then copied over on each update, so pair it with update_every > 1.
+
+For saving and sampling the averaged weights are swapped into the
+model itself (average_parameters), the training weights are kept
+aside and put back afterwards.
+==============================================================='''
+
+
+class EMA():
+    def __init__(self, model, decay=0.9999, update_every=1, device=None):
+        self.decay = decay
+        self.update_every = update_every
+        self.device = device
+        self.shadow = [p.detach().to(device or p.device, dtype=torch.float32, copy=True) for p in model.parameters()]
+        self.backup = None
+        self.num_steps = 0
+        self.num_updates = 0
+
+    def get_decay(self):
+        # warm-up as in diffusers' EMAModel, the first averages would otherwise be dominated by the random init;
+        # the decay of one update covers the update_every steps since the last one
+        decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
+        return decay ** self.update_every
+
+    @torch.no_grad()
+    def step(self, model):
+        '''call after every optimizer step, averages every update_every-th call'''
+        self.num_steps += 1
+        if self.num_steps % self.update_every:
+            return
+        params = [p.detach() for p in model.parameters()]
+        if self.device is not None:
+            params = [p.to(self.device, dtype=torch.float32) for p in params]
+        elif params[0].dtype != torch.float32:
+            params = [p.float() for p in params]
+        decay = self.get_decay()
+        torch._foreach_mul_(self.shadow, decay)
+        torch._foreach_add_(self.shadow, params, alpha=1 - decay)
+        self.num_updates += 1
+
+    @torch.no_grad()
+    def copy_to(self, model):
+        for p, s in zip(model.parameters(), self.shadow):
+            p.copy_(s, non_blocking=True)
+
+    @torch.no_grad()
+    def store(self, model):
+        self.backup = [p.detach().to(self.device or p.device, copy=True) for p in model.parameters()]
+
+    @torch.no_grad()
+    def restore(self, model):
+        for p, b in zip(model.parameters(), self.backup):
+            p.copy_(b, non_blocking=True)
+        self.backup = None
+
+    @contextlib.contextmanager
+    def average_parameters(self, model):
+        self.store(model)
+        self.copy_to(model)
+        try:
+            yield model
+        finally:
+            self.restore(model)
@@ -1,4 +1,5 @@
 import os
+import threading
 import torch
 import torch.nn as nn
 import torchvision.models as models
@@ -29,46 +30,57 @@ images shape: (batch_size, 3, 64, 64)
 labels shape: (batch_size, 24) where labels are one-hot vectors
 e.g. [[1,1,0,...,0],[0,1,1,0,...],...]
 
+Use get_evaluator(device) instead of constructing the model directly:
+the checkpoint is loaded once per (checkpoint, device) and the same
+instance is shared by every caller in the process.
+
 ==============================================================='''
 
 
 class evaluation_model():
-    def __init__(self):
+    def __init__(self, device='cuda', checkpoint_path='dataset/checkpoint.pth'):
         # modify the path to your own path
-        checkpoint = torch.load('dataset/checkpoint.pth')
+        checkpoint = torch.load(checkpoint_path, map_location=device)
         self.resnet18 = models.resnet18(pretrained=False)
         self.resnet18.fc = nn.Sequential(
             nn.Linear(512,24),
             nn.Sigmoid()
         )
         self.resnet18.load_state_dict(checkpoint['model'])
-        self.resnet18 = self.resnet18.cuda()
+        self.resnet18 = self.resnet18.to(device)
         self.resnet18.eval()
+        self.device = device
         self.classnum = 24
 
     def compute_acc(self, out, onehot_labels, filename):
-        batch_size = out.size(0)
-        acc = 0
-        total = 0
-        for i in range(batch_size):
-            k = int(onehot_labels[i].sum().item()) 
-            total += k
-            outv, outi = out[i].topk(k) 
-            lv, li = onehot_labels[i].topk(k)
-            item_acc = 0
-            for j in outi:
-                if j in li:
-                    acc += 1
-                    item_acc += 1
-            # print(f"i:{i}, outi:{outi}, li:{li}")
-            # print(f"Object {str(i)} acc: {item_acc/k * 100:.2f}%")
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            with open(f'{filename}.txt', 'a') as test_record:
-                test_record.write(f'Task {i} : {item_acc/k * 100:.2f}%\n')
-        return acc / total
+        # k (number of objects) differs per image: take the top max(k) predictions
+        # of the whole batch at once and mask the columns past each image's own k
+        k = onehot_labels.sum(dim=1).long()
+        outi = out.topk(int(k.max()), dim=1).indices
+        in_topk = torch.arange(outi.size(1), device=out.device)[None, :] < k[:, None]
+        item_acc = ((onehot_labels.gather(1, outi) > 0) & in_topk).sum(dim=1)
+
+        report = ''.join(f'Task {i} : {hit/n * 100:.2f}%\n'
+                         for i, (hit, n) in enumerate(zip(item_acc.tolist(), k.tolist())))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(f'{filename}.txt', 'a') as test_record:
+            test_record.write(report)
+        return item_acc.sum().item() / k.sum().item()
     def eval(self, images, labels, filename):
         with torch.no_grad():
             #your image shape should be (batch, 3, 64, 64)
-            out = self.resnet18(images)
+            out = self.resnet18(images.to(self.device))
             acc = self.compute_acc(out.cpu(), labels.cpu(), filename)
-            return acc
\ No newline at end of file
+            return acc
+
+
+_evaluators = {}
+_evaluators_lock = threading.Lock()
+
+def get_evaluator(device='cuda', checkpoint_path='dataset/checkpoint.pth'):
+    # built lazily on first use, then reused across batches, epochs and sampling jobs
+    key = (checkpoint_path, str(torch.device(device)))
+    with _evaluators_lock:
+        if key not in _evaluators:
+            _evaluators[key] = evaluation_model(device, checkpoint_path)
+        return _evaluators[key]
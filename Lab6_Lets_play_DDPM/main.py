@@ -1,5 +1,7 @@
-from evaluator import evaluation_model
+from evaluator import get_evaluator
 from dataloader import iclevrLoader
+from sampler import SAMPLERS, get_sampler
+from ema import EMA
 import argparse
 import torch
 import torch.nn as nn
@@ -7,8 +9,13 @@ from torch.utils import data
 from torchvision import transforms
 from torchvision.utils import save_image
 from diffusers import UNet2DModel
-import random
 import os
+import sys
+import glob
+import resource
+import copy
+import contextlib
+import time
 from accelerate import Accelerator
 from diffusers.optimization import get_cosine_schedule_with_warmup
 import torchvision
@@ -16,6 +23,29 @@ import warnings
 from tqdm import tqdm
 
 
+# autocast dtypes, the weights and the optimizer state always stay in float32
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def reset_peak_rss():
+    '''restart the peak resident set size of the process from its current size (Linux only)'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    '''peak resident set size of the process in MiB, ru_maxrss is in bytes on macOS and KiB elsewhere'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
 class Trainer:
     def __init__(self, args, model, optimizer, accelerator):
         self.args = args
@@ -27,21 +57,40 @@ class Trainer:
         self.optimizer = optimizer
         self.lr_scheduler = None 
         self.accelerator = accelerator
+        # built in train_epoch, sample() uses the averaged weights once there are some
+        self.ema = None
 
+        self.device_type = torch.device(self.args.device).type
+        self.memory_format = torch.channels_last if self.args.channels_last else torch.contiguous_format
+        self.model.to(memory_format=self.memory_format)
+        self.set_precision(self.args.precision)
+
+        # the noise schedule lives on the training device, so q-sampling only indexes it there
         self.timestep = 1000
-        self.beta = torch.linspace(1e-4, .002, self.timestep)
+        self.beta = torch.linspace(1e-4, .002, self.timestep, device=self.args.device)
         self.alpha = 1 - self.beta
         self.alpha_cumprod = torch.cumprod(self.alpha, dim=0) # 前t個 timestep 的 alpha 累積乘積
         self.sqrt_alpha_cumprod = torch.sqrt(self.alpha_cumprod)
         self.sqrt_oneminus_alpha_cumprod = torch.sqrt(1 - self.alpha_cumprod)
 
-        self.one_minus_alpha_cumprod_t_minus_1 =  torch.cat((torch.tensor(1).unsqueeze(0), (1 - self.alpha_cumprod)[:-1]))
-        self.one_minus_alpha_cumprod = (1 - self.alpha_cumprod)
-        self.sqrt_variance =  torch.sqrt((self.beta * (self.one_minus_alpha_cumprod_t_minus_1 / self.one_minus_alpha_cumprod)))
+        # reverse process, see sampler.py
+        self.sampler = get_sampler(self.args.sampler, self.beta, num_steps=self.args.sample_steps, eta=self.args.eta)
 
         self.testing_desc = "Testing"
+
+    def set_precision(self, precision):
+        self.precision = precision
+        self.amp_dtype = PRECISIONS[precision]
+        # fp16 gradients underflow without loss scaling, bf16 has the exponent range of fp32 and needs none;
+        # a disabled scaler passes the loss and the optimizer step through unchanged
+        self.scaler = torch.cuda.amp.GradScaler(enabled=(precision == 'fp16'))
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.amp_dtype, enabled=(self.precision != 'fp32'))
     
     def train_epoch(self, epoch):
+        if not self.args.no_ema:
+            self.ema = EMA(self.model, decay=self.args.ema_decay, update_every=self.args.ema_every, device=self.args.ema_device)
         for epoch in range(1, self.args.epochs + 1):
             self.train_loader = self.train_dataloader(self.args, epoch)
 
@@ -56,6 +105,9 @@ class Trainer:
             self.train(epoch)
             if self.args.save_model and (epoch % 1)==0 :
                 self.model.save_pretrained("./model/Unet_" + "epoch_" + str(epoch), variant="non_ema")
+                if self.ema is not None:
+                    with self.ema.average_parameters(self.model):
+                        self.model.save_pretrained("./model/Unet_" + "epoch_" + str(epoch), variant="ema")
                 warnings.filterwarnings("ignore", category=UserWarning, message="The parameter 'pretrained' is deprecated")
                 warnings.filterwarnings("ignore", category=UserWarning, message="Arguments other than a weight enum or `None` for 'weights' are deprecated")
                 
@@ -68,62 +120,52 @@ class Trainer:
         device = self.args.device
         pbar = tqdm(self.train_loader, ncols=120, desc=f"Training Epoch {epoch}")
         for _, (data, cond) in enumerate(pbar):
-            data, cond = data.to(device, dtype=torch.float32), cond.to(device)
+            data, cond = self.normalize(data.to(device)), cond.to(device)
             cond = cond.squeeze()
-            self.optimizer.zero_grad()
-            # select t
-            rand_t = torch.tensor([random.randint(1, self.timestep) for i in range(data.shape[0])])
-            # select noise
-            noise = torch.randn(data.shape[0], 3, 64, 64)
-            xt = self.compute_xt(data, rand_t, noise)
-
-            ''' 
-            Model usage
-            # sample: FloatTensor
-            # timestep: typing.Union[torch.Tensor, float, int]
-            # class_labels: typing.Optional[torch.Tensor] = None
-            # return_dict: bool = True 
-            # output shape = (batch_size, num_channels, height, width))
-            '''
-
-            output = self.model(sample=xt.to(device), timestep=rand_t.to(device), class_labels=cond.to(torch.float32).to(device))
-            loss = nn.MSELoss()(output.sample.to(device), noise.to(device))
-            self.accelerator.backward(loss)
+            loss = self.train_step(data, cond)
             self.lr_scheduler.step()
-            self.optimizer.step()
+            if self.ema is not None:
+                self.ema.step(self.model)
 
             pbar.set_postfix(loss=loss.item(), lr=self.lr_scheduler.get_last_lr()[0])
 
-    def compute_xt(self, data, rand_t, noise):
-        # caculate coefficient
-        coef_x0 = []
-        coef_noise = []
-        # select coefficient
-        for i in range(data.shape[0]):
-            coef_x0.append(self.sqrt_alpha_cumprod[rand_t[i]-1])
-            coef_noise.append(self.sqrt_oneminus_alpha_cumprod[rand_t[i]-1])
-
-        coef_x0 = torch.tensor(coef_x0)
-        coef_noise = torch.tensor(coef_noise)
+    def train_step(self, data, cond):
+        self.optimizer.zero_grad()
+        # select t in [1, timestep]
+        rand_t = torch.randint(1, self.timestep + 1, (data.shape[0],), device=data.device)
+        # select noise
+        noise = torch.randn_like(data)
+        xt = self.compute_xt(data, rand_t, noise).contiguous(memory_format=self.memory_format)
+
+        ''' 
+        Model usage
+        # sample: FloatTensor
+        # timestep: typing.Union[torch.Tensor, float, int]
+        # class_labels: typing.Optional[torch.Tensor] = None
+        # return_dict: bool = True 
+        # output shape = (batch_size, num_channels, height, width))
+        '''
+
+        with self.autocast():
+            output = self.model(sample=xt, timestep=rand_t, class_labels=cond.to(torch.float32))
+        # the loss is reduced in float32 whatever the autocast dtype
+        loss = nn.MSELoss()(output.sample.float(), noise)
+        self.accelerator.backward(self.scaler.scale(loss))
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        return loss
+
+    def normalize(self, data):
+        # packed images arrive as uint8, apply Normalize((0.5,)*3, (0.5,)*3) to the batch on the device
+        if data.dtype == torch.uint8:
+            return data.float().div_(127.5).sub_(1)
+        return data.to(torch.float32)
 
-        coef_x0 = coef_x0[:, None, None, None]
-        coef_noise = coef_noise[:, None, None, None]
-
-        device = self.args.device
-
-        return coef_noise.to(device) * noise.to(device) + coef_x0.to(device) * data.to(device)
-
-    def compute_prev_x(self, xt, t, pred_noise, args):
-        coef = 1/torch.sqrt(self.alpha[t-1])
-        noise_coef = self.beta[t-1] / self.sqrt_oneminus_alpha_cumprod[t-1]
-        if t <= 1 :
-            z = 0
-        else:
-            z = torch.randn(self.args.test_batch, 3, 64, 64)
-        sqrt_var = self.sqrt_variance[t-1] 
-        mean = coef * (xt - noise_coef * pred_noise)
-        prev_x = mean.to("cpu") + sqrt_var.to("cpu") * z
-        return prev_x
+    def compute_xt(self, data, rand_t, noise):
+        # q(x_t | x_0) for the whole batch: gather the coefficients of each sample's t
+        coef_x0 = self.sqrt_alpha_cumprod[rand_t - 1][:, None, None, None]
+        coef_noise = self.sqrt_oneminus_alpha_cumprod[rand_t - 1][:, None, None, None]
+        return coef_noise * noise + coef_x0 * data
 
     def sample(self, model, device, test_loader, args, filename):
         # denormalize
@@ -132,21 +174,26 @@ class Trainer:
                 transforms.Normalize((-0.5, -0.5, -0.5), (1, 1, 1)),
             ])
         model.eval()
-        xt = torch.randn(args.test_batch, 3, 64, 64)
-        with torch.no_grad():
+        # sample with the EMA weights when they are kept, the training weights are restored afterwards
+        average = self.ema.average_parameters(model) if self.ema is not None else contextlib.nullcontext()
+        with torch.no_grad(), average:
             # pbar = tqdm(self.test_loader, ncols=120, desc="Testing")
             for _, (img, cond) in enumerate(test_loader):
                 cond = cond.to(device)
                 cond = cond.squeeze()
-                for t in range(self.timestep, 0, -1):
-                    # pred noise
-                    output = model(sample = xt.to(args.device), timestep = t, class_labels = cond.to(torch.float32).to(args.device))
-                    # compute xt-1
-                    xt = self.compute_prev_x(xt.to(args.device), t, output.sample.to(args.device), args)
-
-                # evaluate
-                evaluate = evaluation_model()
-                acc = evaluate.eval(xt.to(args.device), cond.to(args.device), filename)
+                start_time = time.time()
+                xt = torch.randn(cond.shape[0], 3, 64, 64, device=device).contiguous(memory_format=self.memory_format)
+                # the model runs under autocast, the sampler updates of xt are promoted back to float32
+                with self.autocast():
+                    xt = self.sampler.sample(model, xt, cond.to(torch.float32))
+                xt = xt.float()
+                if torch.device(device).type == 'cuda':
+                    torch.cuda.synchronize()
+                print(f"Sampling ({args.sampler}, {len(self.sampler.timesteps())} steps, {self.precision}): {xt.shape[0] / (time.time() - start_time):.2f} images/sec")
+
+                # evaluate with the classifier shared by the whole process
+                evaluate = get_evaluator(args.eval_device or device)
+                acc = evaluate.eval(xt, cond, filename)
 
                 # torch.save(xt, f = filename+".pt")
                 print(f"Testing acc: {acc*100:.2f}%")
@@ -159,12 +206,66 @@ class Trainer:
                 img = transform(xt)
                 self.save_images(img, name=filename)
 
+    def measure(self, step, steps):
+        '''steps/sec and peak memory (MiB) of `steps` calls of step
+
+        The peak is the allocated memory on cuda and the resident set size of the process
+        on cpu. The cpu peak can only be reset on Linux, elsewhere it covers the whole run.
+        '''
+        cuda = self.device_type == 'cuda'
+        step()  # warm-up, excluded from the timing
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            reset_peak_rss()
+        start_time = time.time()
+        for _ in range(steps):
+            step()
+        if cuda:
+            torch.cuda.synchronize()
+        rate = steps / (time.time() - start_time)
+        peak = torch.cuda.max_memory_allocated() / 2**20 if cuda else peak_rss()
+        return rate, peak
+
+    def benchmark(self, precisions, steps):
+        '''compare training and denoising steps of the loaded checkpoint under each precision
+
+        Every precision trains a fresh copy of the model with its own optimizer, the
+        loaded weights are left untouched. Inputs are random, only the speed matters.
+        '''
+        device = self.args.device
+        model, optimizer, precision = self.model, self.optimizer, self.precision
+        data = torch.rand(self.args.train_batch, 3, 64, 64, device=device) * 2 - 1
+        cond = (torch.rand(self.args.train_batch, 24, device=device) < 0.1).float()
+        xt = torch.randn(self.args.test_batch, 3, 64, 64, device=device).contiguous(memory_format=self.memory_format)
+        sample_cond = (torch.rand(self.args.test_batch, 24, device=device) < 0.1).float()
+
+        def denoise_step():
+            with torch.no_grad(), self.autocast():
+                return self.model(sample=xt, timestep=self.timestep, class_labels=sample_cond).sample
+
+        print(f"{'precision':>10} {'train steps/s':>14} {'train MiB':>10} {'sample steps/s':>15} {'sample MiB':>11}")
+        for name in precisions:
+            self.model = copy.deepcopy(model)
+            self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=self.args.lr)
+            self.set_precision(name)
+            self.model.train()
+            train_rate, train_peak = self.measure(lambda: self.train_step(data, cond), steps)
+            self.model.eval()
+            sample_rate, sample_peak = self.measure(denoise_step, steps)
+            print(f"{name:>10} {train_rate:>14.2f} {train_peak:>10.0f} {sample_rate:>15.2f} {sample_peak:>11.0f}")
+            del self.model, self.optimizer
+
+        self.model, self.optimizer = model, optimizer
+        self.set_precision(precision)
+
     def save_images(self, images, name):
         grid = torchvision.utils.make_grid(images)
         save_image(grid, fp = name + ".png")
 
     def train_dataloader(self, args, epoch):
-        dataset = iclevrLoader(root="./dataset/", mode="train", partial=args.fast_partial if args.fast_train else args.partial)
+        dataset = iclevrLoader(root="./dataset/", mode="train", partial=args.fast_partial if args.fast_train else args.partial, packed=args.packed)
 
         if epoch > args.fast_train_epoch:
             args.fast_train = False
@@ -189,8 +290,23 @@ def main():
     parser.add_argument('--fast_train',         action='store_true')
     parser.add_argument('--fast_partial',       type=float,          default=0.4,    help="Use part of the training data to fasten the convergence")
     parser.add_argument('--fast_train_epoch',   type=int,            default=10,      help="Number of epoch to use fast train mode")
+    parser.add_argument('--packed',             action='store_true',                  help="Train from the pre-resized uint8 image pack (built on first use)")
+    parser.add_argument('--sampler',            type=str,            default='ddpm',  choices=list(SAMPLERS), help="Reverse process used for sampling")
+    parser.add_argument('--sample_steps',       type=int,            default=50,      help="Number of denoising steps of the ddim sampler")
+    parser.add_argument('--eta',                type=float,          default=0.0,     help="Stochasticity of the ddim sampler, 0 is deterministic")
+    parser.add_argument('--eval_device',        type=str,            default=None,    help="Device of the evaluation classifier, defaults to --device")
+    parser.add_argument('--precision',          type=str,            default='fp32',  choices=list(PRECISIONS), help="Autocast dtype of training and sampling, fp16 uses loss scaling")
+    parser.add_argument('--channels_last',      action='store_true',                  help="Keep the UNet weights and inputs in channels-last memory format")
+    parser.add_argument('--benchmark',          action='store_true',                  help="Compare steps/sec and peak memory of every precision on the loaded checkpoint")
+    parser.add_argument('--benchmark_steps',    type=int,            default=20,      help="Number of timed steps per precision in benchmark mode")
+    parser.add_argument('--no_ema',             action='store_true',                  help="Do not keep an EMA of the weights, sample with the training weights")
+    parser.add_argument('--ema_decay',          type=float,          default=0.9999,  help="Decay of the weight EMA per training step")
+    parser.add_argument('--ema_every',          type=int,            default=1,       help="Update the EMA every N training steps")
+    parser.add_argument('--ema_device',         type=str,            default=None,    help="Device of the EMA weights, e.g. cpu, defaults to the model's device")
 
     args = parser.parse_args()
+    if args.precision == 'fp16' and torch.device(args.device).type != 'cuda':
+        parser.error("--precision fp16 needs a cuda device, use bf16 on cpu")
     
     # Training
     # model
@@ -212,10 +328,12 @@ def main():
     # trainer.train_epoch(args.epochs)
 
 
-    # DEMO: load model and generate images
-    model = UNet2DModel.from_pretrained(pretrained_model_name_or_path ="./model/Unet_epoch_200", variant="non_ema", from_tf=True, low_cpu_mem_usage=False, ignore_mismatched_sizes=True)
+    # DEMO: load model and generate images, with the EMA weights when the checkpoint has them
+    variant = "ema" if not args.no_ema and glob.glob("./model/Unet_epoch_200/diffusion_pytorch_model.ema.*") else "non_ema"
+    print(f"> Sampling with the {variant} weights")
+    model = UNet2DModel.from_pretrained(pretrained_model_name_or_path ="./model/Unet_epoch_200", variant=variant, from_tf=True, low_cpu_mem_usage=False, ignore_mismatched_sizes=True)
     model.class_embedding = nn.Linear(24 ,512)
-    state_dict = torch.load("./model/UNet_epoch_200/diffusion_pytorch_model.non_ema.bin")
+    state_dict = torch.load(f"./model/UNet_epoch_200/diffusion_pytorch_model.{variant}.bin")
     filtered_state_dict = {k[16:]: v for k, v in state_dict.items() if k =="class_embedding.weight" or k=="class_embedding.bias"}
     model.class_embedding.load_state_dict(filtered_state_dict)
     model = model.to(args.device)
@@ -228,6 +346,10 @@ def main():
     model, optimizer = accelerator.prepare(model, optimizer)
 
     tester = Trainer(args, model, optimizer, accelerator)
+    if args.benchmark:
+        # fp16 autocast with loss scaling is only supported on cuda
+        tester.benchmark([p for p in PRECISIONS if p != 'fp16' or tester.device_type == 'cuda'], args.benchmark_steps)
+        return
     tester.sample(model, args.device, test_loader, args, "./demo/test/test_200")
     tester.sample(model, args.device, new_test_loader, args, "./demo/new_test/new_test_200")
 
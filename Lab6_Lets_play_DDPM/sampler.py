@@ -0,0 +1,78 @@
+import torch
+
+'''===============================================================
+Reverse-diffusion samplers for the conditional UNet.
+
+Every sampler is built from the beta schedule the model was trained
+with (Trainer.beta), so they all reuse the same checkpoint. Timesteps
+follow the training convention t = 1 .. T, the schedule is indexed
+with t-1. Everything stays on the device of the schedule.
+
+  ddpm : ancestral sampling over all T steps (Ho et al., 2020)
+  ddim : deterministic (eta=0) sampling over a strided subset of the
+         steps, e.g. 50 or 100 (Song et al., 2021)
+==============================================================='''
+
+
+class DDPMSampler():
+    def __init__(self, beta):
+        self.timestep = len(beta)
+        self.beta = beta
+        self.alpha = 1 - beta
+        self.alpha_cumprod = torch.cumprod(self.alpha, dim=0)
+        self.sqrt_oneminus_alpha_cumprod = torch.sqrt(1 - self.alpha_cumprod)
+        alpha_cumprod_prev = torch.cat((torch.ones(1, device=beta.device), self.alpha_cumprod[:-1]))
+        self.sqrt_variance = torch.sqrt(self.beta * (1 - alpha_cumprod_prev) / (1 - self.alpha_cumprod))
+
+    def timesteps(self):
+        return list(range(self.timestep, 0, -1))
+
+    def step(self, pred_noise, t, t_prev, xt):
+        coef = 1 / torch.sqrt(self.alpha[t-1])
+        noise_coef = self.beta[t-1] / self.sqrt_oneminus_alpha_cumprod[t-1]
+        mean = coef * (xt - noise_coef * pred_noise)
+        if t <= 1:
+            return mean
+        return mean + self.sqrt_variance[t-1] * torch.randn_like(xt)
+
+    @torch.no_grad()
+    def sample(self, model, xt, class_labels):
+        timesteps = self.timesteps()
+        for t, t_prev in zip(timesteps, timesteps[1:] + [0]):
+            pred_noise = model(sample=xt, timestep=t, class_labels=class_labels).sample
+            xt = self.step(pred_noise, t, t_prev, xt)
+        return xt
+
+
+class DDIMSampler(DDPMSampler):
+    def __init__(self, beta, num_steps=50, eta=0.0):
+        super().__init__(beta)
+        self.num_steps = min(num_steps, self.timestep)
+        self.eta = eta
+
+    def timesteps(self):
+        # evenly strided from T down to 1
+        steps = torch.linspace(self.timestep, 1, self.num_steps).round().long()
+        return sorted(set(steps.tolist()), reverse=True)
+
+    def step(self, pred_noise, t, t_prev, xt):
+        alpha_cumprod_t = self.alpha_cumprod[t-1]
+        alpha_cumprod_prev = self.alpha_cumprod[t_prev-1] if t_prev > 0 else torch.ones_like(alpha_cumprod_t)
+        pred_x0 = (xt - torch.sqrt(1 - alpha_cumprod_t) * pred_noise) / torch.sqrt(alpha_cumprod_t)
+        sigma = self.eta * torch.sqrt((1 - alpha_cumprod_prev) / (1 - alpha_cumprod_t) * (1 - alpha_cumprod_t / alpha_cumprod_prev))
+        prev_x = torch.sqrt(alpha_cumprod_prev) * pred_x0 + torch.sqrt(1 - alpha_cumprod_prev - sigma**2) * pred_noise
+        if self.eta > 0 and t_prev > 0:
+            prev_x = prev_x + sigma * torch.randn_like(xt)
+        return prev_x
+
+
+SAMPLERS = {
+    'ddpm': DDPMSampler,
+    'ddim': DDIMSampler,
+}
+
+
+def get_sampler(name, beta, num_steps=50, eta=0.0):
+    if name == 'ddim':
+        return DDIMSampler(beta, num_steps=num_steps, eta=eta)
+    return SAMPLERS[name](beta)